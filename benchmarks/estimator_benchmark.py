@@ -0,0 +1,56 @@
+# Compares the NewtonRaphsonEstimator with catsim's DifferentialEvolutionEstimator on simulated response vectors.
+# Run from the repository root: python -m benchmarks.estimator_benchmark [--items 50] [--examinees 200]
+import argparse
+import time
+
+import numpy as np
+from catsim import irt
+from catsim.cat import generate_item_bank
+from catsim.estimation import DifferentialEvolutionEstimator
+
+from src.cat.estimation import NewtonRaphsonEstimator
+
+
+def simulate_responses(items: np.ndarray, theta: float, rng: np.random.Generator):
+    return rng.random(items.shape[0]) < irt.icc(theta, items[:, 0], items[:, 1], items[:, 2], items[:, 3])
+
+
+def time_estimator(estimator, cases: list):
+    estimates = []
+    start = time.perf_counter()
+    for items, responses, est_theta in cases:
+        estimates.append(estimator.estimate(items=items, administered_items=list(range(items.shape[0])),
+                                            response_vector=list(responses), est_theta=est_theta))
+    return (time.perf_counter() - start) / len(cases), np.array(estimates)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=50, help="length of the response vectors")
+    parser.add_argument("--examinees", type=int, default=200)
+    parser.add_argument("--item-type", default="1PL", help="1PL (as stored by the cat engine) to 4PL")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    np.random.seed(args.seed)  # catsim uses the global random state
+    cases = []
+    for _ in range(args.examinees):
+        items = generate_item_bank(args.items, args.item_type)
+        theta = rng.normal()
+        cases.append((items, simulate_responses(items, theta, rng), theta + rng.normal(scale=0.3)))
+    bounds = (min(items[:, 1].min() for items, _, _ in cases), max(items[:, 1].max() for items, _, _ in cases))
+
+    de_time, de_estimates = time_estimator(DifferentialEvolutionEstimator(bounds), cases)
+    nr_time, nr_estimates = time_estimator(NewtonRaphsonEstimator(bounds), cases)
+
+    differences = np.abs(de_estimates - nr_estimates)
+    print(f"{args.examinees} response vectors of {args.items} {args.item_type} items")
+    print(f"DifferentialEvolutionEstimator: {de_time * 1000:8.3f} ms per estimation")
+    print(f"NewtonRaphsonEstimator:         {nr_time * 1000:8.3f} ms per estimation")
+    print(f"speedup:                        {de_time / nr_time:8.1f}x")
+    print(f"difference to DE: mean {differences.mean():.2e}, max {differences.max():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+# End-to-end load test of the REST API: simulated examinees take adaptive quizzes concurrently
+# (POST /quiz -> POST /quiz/{id}/question until finished -> GET /quiz/{id}/result -> DELETE /quiz) against CATModule
+# in this process. Local stand-ins replace the external services: fakeredis (or a local Redis with --redis-url),
+# SQLite instead of MySQL and a generated item bank instead of Neo4j. The answers are drawn from the 1PL model with
+# a true competency per examinee. Requests/sec and p50/p95/p99 latencies per endpoint and per engine stage are
+# printed and written to a JSON file, so the results of two commits can be compared.
+# Needs httpx, fakeredis and aiosqlite. Run from the repository root:
+#   python -m benchmarks.load_test [--examinees 200] [--concurrency 50] [--output load_test.json] [--compare old.json]
+import argparse
+import asyncio
+import functools
+import importlib
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from catsim import irt
+
+LOAD_TEST_TOPIC = "loadTest"
+
+# engine functions timed as stages: (stage, module, attribute)
+TIMED_STAGES = [
+    ("loadState", "src.main", "load_quiz_state_async"),
+    ("initQuiz", "src.cat.cat_engine", "init_quiz_state"),
+    ("advanceQuiz", "src.cat.cat_engine", "advance_quiz"),
+    ("select", "src.cat.selection", "IndexedSelector.select"),
+    ("estimate", "src.cat.estimation", "NewtonRaphsonEstimator.estimate"),
+    ("estimate", "catsim.estimation", "DifferentialEvolutionEstimator.estimate"),
+    ("saveState", "src.cat.quiz_state", "QuizState.save_async"),
+    ("buildResult", "src.cat.cat_engine", "build_result"),
+    ("log", "src.cat.cat_engine", "log"),
+]
+
+
+# --------------- Stand-ins ---------------
+
+# Neo4j driver returning the questions of the generated item bank
+class StubGraphDatabase:
+    def __init__(self, question_ids: list, difficulties: list):
+        self.records = [{"id": question_id, "difficulty": difficulty}
+                        for question_id, difficulty in zip(question_ids, difficulties)]
+
+    def session(self, **kwargs):
+        return StubGraphSession(self.records)
+
+    def close(self):
+        pass
+
+
+class StubGraphSession:
+    def __init__(self, records: list):
+        self.records = records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, query: str, topic_id: str = None, **parameters):
+        return self.records if topic_id == LOAD_TEST_TOPIC else []
+
+
+# registers the stand-in modules for the connectors, must run before anything of src is imported
+def install_stand_ins(work_dir: Path, redis_url: str, question_ids: list, difficulties: list):
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+
+    if redis_url is None:
+        import fakeredis
+        import fakeredis.aioredis
+        server = fakeredis.FakeServer()
+        r = fakeredis.FakeRedis(server=server)
+        ar = fakeredis.aioredis.FakeRedis(server=server)
+    else:
+        import redis
+        import redis.asyncio
+        r = redis.Redis.from_url(redis_url)
+        ar = redis.asyncio.Redis.from_url(redis_url)
+
+    db_file = work_dir / "load_test.sqlite"
+    db_connector = types.ModuleType("src.cat.db_connector")
+    db_connector.r = r
+    db_connector.engine = create_engine(f"sqlite:///{db_file}")
+    sys.modules["src.cat.db_connector"] = db_connector
+
+    async_db_connector = types.ModuleType("src.cat.async_db_connector")
+    async_db_connector.ar = ar
+    async_db_connector.async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_file}")
+    async_db_connector.AsyncSessionLocal = sessionmaker(bind=async_db_connector.async_engine, class_=AsyncSession,
+                                                        expire_on_commit=False)
+    sys.modules["src.cat.async_db_connector"] = async_db_connector
+
+    graphdb = StubGraphDatabase(question_ids, difficulties)
+    neo4j_connector = types.ModuleType("src.cat.neo4j_connector")
+    neo4j_connector.NEO4J_FETCH_SIZE = 5000
+    neo4j_connector.get_graphdb = lambda: graphdb
+    neo4j_connector.close_graphdb = lambda: None
+    neo4j_connector.create_indexes = lambda: None
+    sys.modules["src.cat.neo4j_connector"] = neo4j_connector
+
+    import config
+    config.log_settings["ce_logfile"] = str(work_dir / "ce_logfile.csv")  # keep the logs of the load test apart
+
+    from src.models.sqlalchemy_models import Base
+    Base.metadata.create_all(db_connector.engine)
+
+
+# --------------- Measurement ---------------
+
+# collects the duration of every call of the timed stages (called from the event loop and the executor threads)
+class StageTimings:
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    def wrap(self, stage: str, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.durations[stage].append(time.perf_counter() - start)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations[stage].append(time.perf_counter() - start)
+        return timed
+
+    def install(self):
+        for stage, module_name, attribute in TIMED_STAGES:
+            target = importlib.import_module(module_name)
+            *owners, name = attribute.split(".")
+            for owner in owners:
+                target = getattr(target, owner)
+            setattr(target, name, self.wrap(stage, getattr(target, name)))
+
+
+def summarize(durations: list, wall_time: float):
+    milliseconds = np.array(durations) * 1000
+    return {
+        "count": len(durations),
+        "rps": len(durations) / wall_time,
+        "mean": float(milliseconds.mean()),
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p95": float(np.percentile(milliseconds, 95)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "max": float(milliseconds.max()),
+    }
+
+
+# --------------- Examinees ---------------
+
+class LoadTest:
+    def __init__(self, client, difficulties: dict, quiz: dict, rng: np.random.Generator):
+        self.client = client
+        self.difficulties = difficulties  # question id -> difficulty
+        self.quiz = quiz
+        self.rng = rng
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.questions_per_quiz = []
+
+    async def request(self, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[endpoint] += 1
+            return None
+        return response.json()
+
+    # one examinee taking a quiz from creation to deletion
+    async def run_examinee(self, theta: float):
+        quiz = await self.request("POST /quiz", "POST", "/quiz", json=self.quiz)
+        if quiz is None:
+            return
+        quiz_id = quiz["quizId"]
+        is_correct = None
+        questions = 0
+        while True:
+            question = await self.request("POST /quiz/{id}/question", "POST", f"/quiz/{quiz_id}/question",
+                                          json={"isCorrect": is_correct})
+            if question is None or question["quizFinished"]:
+                break
+            questions += 1
+            difficulty = self.difficulties[question["questionId"]]
+            is_correct = float(self.rng.random() < irt.icc(theta, 1.0, difficulty, 0.0, 1.0))
+        self.questions_per_quiz.append(questions)
+        await self.request("GET /quiz/{id}/result", "GET", f"/quiz/{quiz_id}/result")
+        await self.request("DELETE /quiz", "DELETE", "/quiz", json={"quizId": quiz_id})
+
+    async def run(self, thetas: list, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_limited(theta: float):
+            async with semaphore:
+                await self.run_examinee(theta)
+
+        await asyncio.gather(*[run_limited(theta) for theta in thetas])
+
+
+async def run_load_test(args, question_ids: list, difficulties: list):
+    import httpx
+
+    import src.main
+    timings = StageTimings()
+    timings.install()
+
+    await src.main.startup()
+    # global calibration parameters, normally set through the form of the home page
+    await src.main.ce.set_calibration_params_async(args.denominator, args.update_rate)
+    quiz = {"topicId": LOAD_TEST_TOPIC, "maxNumberOfQuestions": args.max_questions,
+            "minMeasurementAccuracy": args.min_accuracy, "questionSelector": args.selector,
+            "competencyEstimator": args.estimator}
+    rng = np.random.default_rng(args.seed)
+    thetas = list(rng.normal(args.theta_mean, args.theta_sd, args.examinees))
+    transport = httpx.ASGITransport(app=src.main.CATModule)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test") as client:
+        load_test = LoadTest(client, dict(zip(question_ids, difficulties)), quiz, rng)
+        await load_test.run(thetas[:args.warmup], args.concurrency)  # fill the item bank cache and the executor
+        load_test.latencies.clear()
+        load_test.errors.clear()
+        load_test.questions_per_quiz.clear()
+        timings.durations.clear()
+
+        start = time.perf_counter()
+        await load_test.run(thetas, args.concurrency)
+        wall_time = time.perf_counter() - start
+    await src.main.shutdown()
+
+    total_requests = sum(len(latencies) for latencies in load_test.latencies.values())
+    return {
+        "wallTime": wall_time,
+        "requests": total_requests,
+        "rps": total_requests / wall_time,
+        "quizzesPerSecond": len(load_test.questions_per_quiz) / wall_time,
+        "meanQuestionsPerQuiz": float(np.mean(load_test.questions_per_quiz)) if load_test.questions_per_quiz else 0,
+        "errors": dict(load_test.errors),
+        "endpoints": {endpoint: summarize(latencies, wall_time)
+                      for endpoint, latencies in load_test.latencies.items()},
+        "stages": {stage: summarize(durations, wall_time) for stage, durations in timings.durations.items()},
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(title: str, rows: dict):
+    print(f"{title:<28} {'count':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in rows.items():
+        print(f"{name:<28} {row['count']:>7} {row['rps']:>9.1f} {row['p50']:>9.2f} {row['p95']:>9.2f} "
+              f"{row['p99']:>9.2f} {row['max']:>9.2f}")
+
+
+# prints the change of the p95 latencies against the results of an earlier run
+def print_comparison(results: dict, baseline_file: str):
+    baseline = json.loads(Path(baseline_file).read_text())
+    print(f"p95 compared to {baseline_file} (commit {baseline['commit']}):")
+    for section in ("endpoints", "stages"):
+        for name, row in results[section].items():
+            if name in baseline["results"][section]:
+                before = baseline["results"][section][name]["p95"]
+                print(f"  {name:<26} {before:>9.2f} -> {row['p95']:>9.2f} ms ({(row['p95'] / before - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--examinees", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="examinees taking a quiz at the same time")
+    parser.add_argument("--warmup", type=int, default=10, help="examinees run before measuring")
+    parser.add_argument("--items", type=int, default=500, help="size of the item bank")
+    parser.add_argument("--max-questions", type=int, default=20)
+    parser.add_argument("--min-accuracy", type=float, default=0.4)
+    parser.add_argument("--selector", default="maxInfoSelector")
+    parser.add_argument("--estimator", default="newtonRaphsonEstimator")
+    parser.add_argument("--denominator", type=float, default=400)
+    parser.add_argument("--update-rate", type=float, default=0.05)
+    parser.add_argument("--theta-mean", type=float, default=0.5)
+    parser.add_argument("--theta-sd", type=float, default=0.5)
+    parser.add_argument("--redis-url", default=None, help="local Redis to use instead of fakeredis")
+    parser.add_argument("--output", default="load_test.json")
+    parser.add_argument("--compare", default=None, help="results file of an earlier run to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    question_ids = list(range(1, args.items + 1))
+    difficulties = list(rng.uniform(0.0, 1.0, args.items))
+    with tempfile.TemporaryDirectory(prefix="cat-load-test-") as work_dir:
+        install_stand_ins(Path(work_dir), args.redis_url, question_ids, difficulties)
+        results = asyncio.run(run_load_test(args, question_ids, difficulties))
+
+    report = {
+        "commit": get_commit(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+
+    print(f"{args.examinees} examinees, concurrency {args.concurrency}: {results['requests']} requests in "
+          f"{results['wallTime']:.2f} s ({results['rps']:.1f} req/s, {results['quizzesPerSecond']:.1f} quizzes/s, "
+          f"{results['meanQuestionsPerQuiz']:.1f} questions per quiz), errors: {results['errors'] or 'none'}")
+    print_table("endpoint", results["endpoints"])
+    print_table("stage", results["stages"])
+    if args.compare is not None:
+        print_comparison(results, args.compare)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# Micro-benchmarks of the hot helpers of the CAT engine, parameterized over the size of the item bank and the number
+# of answers of the quiz. Redis and the db are replaced by the stand-ins of benchmarks.load_test (fakeredis and a
+# sqlite file, apply_calibration_jobs runs MICRO_BENCHMARK_CALIBRATION_JOBS jobs against it).
+# The time per call of each benchmark is compared with the baseline stored for it: the run fails (exit code 1) if a
+# benchmark got slower than the threshold. Baselines depend on the machine, they are recorded on the first run of a
+# benchmark and replaced with --update-baselines.
+# Needs fakeredis and aiosqlite. Run from the repository root:
+#   python -m benchmarks.micro_benchmark [--banks 100 1000 10000 100000] [--lengths 1 10 100] [--threshold 0.25]
+import argparse
+import json
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.load_test import install_stand_ins
+
+MICRO_BENCHMARK_TOPIC = "microBenchmark"
+
+DEFAULT_BASELINES_FILE = Path(__file__).parent / "micro_baselines.json"
+
+# benchmarks are repeated this many times, the fastest repetition counts
+MICRO_BENCHMARK_REPEAT = 5
+
+# number of calibration jobs applied together by the apply_calibration_jobs benchmark
+MICRO_BENCHMARK_CALIBRATION_JOBS = 100
+
+
+# quiz with the given number of answers on an item bank of the given size, stored in Redis, and calibration jobs of
+# quizzes with the same length on the questions of the bank, stored in the db
+class BenchmarkCase:
+    def __init__(self, bank_size: int, quiz_length: int, rng: np.random.Generator):
+        from src.cat.calibration import CalibrationJob, create_calibration_job
+        from src.cat.db_session import bulk_upsert, session_scope
+        from src.cat.item_bank import ItemBank, publish_topic_bank
+        from src.cat.quiz_id_generator import next_quiz_id
+        from src.cat.quiz_state import QuizState
+        from src.models.sqlalchemy_models import Difficulty
+
+        self.bank_size = bank_size
+        self.quiz_length = quiz_length
+        # the question ids of the banks of the default sizes do not overlap, so the calibration only updates the
+        # difficulties of one topic
+        question_ids = list(range(bank_size, 2 * bank_size))
+        bank = ItemBank.from_difficulties(rng.uniform(0.0, 1.0, bank_size), question_ids,
+                                          [str(question_id) for question_id in question_ids])
+        topic_id = f"{MICRO_BENCHMARK_TOPIC}{bank_size}"
+        bank_version = publish_topic_bank(topic_id, bank)
+        with session_scope() as session:
+            bulk_upsert(session, Difficulty, [{"question_id": question_id, "topic_id": topic_id,
+                                               "difficulty": float(difficulty)}
+                                              for question_id, difficulty in zip(question_ids, bank.items[:, 1])],
+                        ["difficulty"])
+        self.quiz_id = next_quiz_id()
+        self.state = QuizState(self.quiz_id, {
+            "maxNumberOfQuestions": quiz_length + 1,
+            "minMeasurementAccuracy": 0.0,
+            "inputProficiencyLevel": 0.5,
+            "questionSelector": "maxInfoSelector",
+            "competencyEstimator": "newtonRaphsonEstimator",
+            "topicId": topic_id,
+            "bankVersion": bank_version,
+            "standardErrorOfEstimation": 1.0,
+            "quizFinished": False,
+            "estTheta": 0.5,
+            "minDiff": float(bank.items[:, 1].min()),
+            "maxDiff": float(bank.items[:, 1].max()),
+        })
+        for item_index in rng.choice(bank_size, quiz_length, replace=False):
+            self.state.add_administered_item(item_index)
+            self.state.add_response(float(rng.random() < 0.5))
+        self.state.save()
+        self.items = bank.items
+        self.administered_items = self.state.get_administered_items()
+        self.responses = self.state.get_responses()
+        self.job = create_calibration_job(self.state, b"400", b"0.05")
+        self.calibration_jobs = []
+        for _ in range(MICRO_BENCHMARK_CALIBRATION_JOBS):
+            item_indexes = rng.choice(bank_size, quiz_length, replace=False)
+            self.calibration_jobs.append(CalibrationJob(next_quiz_id(),
+                                                        [question_ids[item_index] for item_index in item_indexes],
+                                                        [float(bank.items[item_index, 1])
+                                                         for item_index in item_indexes],
+                                                        [bool(answer) for answer in rng.random(quiz_length) < 0.5],
+                                                        0.5, 400, 0.05))
+
+    def with_estimator(self, competency_estimator: str):
+        self.state.fields["competencyEstimator"] = competency_estimator
+        return self.state
+
+
+# applies the calibration jobs to the db and rolls the transaction back, so every call applies the same jobs
+def apply_calibration_jobs_rolled_back(jobs: list):
+    from src.cat.calibration import apply_calibration_jobs
+    from src.cat.db_session import SessionLocal
+
+    with SessionLocal() as session:
+        apply_calibration_jobs(session, jobs)
+        session.flush()
+        session.rollback()
+
+
+# returns the benchmarks as name -> function creating the benchmarked call for a case
+def get_benchmarks():
+    from catsim import irt
+
+    import src.cat.cat_engine as ce
+    from src.cat.calibration import calibrate_items
+
+    return {
+        "get_items": lambda case: lambda: ce.get_items(case.quiz_id),
+        "get_administered_items": lambda case: lambda: ce.get_administered_items(case.quiz_id),
+        "get_responses": lambda case: lambda: ce.get_responses(case.quiz_id),
+        "select": lambda case: lambda: ce.get_selector(case.state).select(
+            items=case.items, administered_items=case.administered_items, est_theta=0.5),
+        "estimate_newton_raphson": lambda case: lambda: ce.get_estimator(
+            case.with_estimator("newtonRaphsonEstimator")).estimate(
+            items=case.items, administered_items=case.administered_items, response_vector=case.responses,
+            est_theta=0.5),
+        "estimate_differential_evolution": lambda case: lambda: ce.get_estimator(
+            case.with_estimator("differentialEvolutionEstimator")).estimate(
+            items=case.items, administered_items=case.administered_items, response_vector=case.responses,
+            est_theta=0.5),
+        "see": lambda case: lambda: irt.see(theta=0.5, items=case.items[case.administered_items]),
+        "calibrate_items": lambda case: lambda: calibrate_items(case.job),
+        "apply_calibration_jobs": lambda case: lambda: apply_calibration_jobs_rolled_back(case.calibration_jobs),
+    }
+
+
+# returns the fastest time per call in seconds
+def time_call(call):
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=MICRO_BENCHMARK_REPEAT, number=number)) / number
+
+
+def format_time(seconds: float):
+    for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= factor:
+            return f"{seconds / factor:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--banks", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="item bank sizes")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1, 10, 100], help="numbers of answers")
+    parser.add_argument("--filter", default=None, help="only run the benchmarks containing this text")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--baselines", default=str(DEFAULT_BASELINES_FILE))
+    parser.add_argument("--update-baselines", action="store_true", help="replace the baselines with this run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    baselines_file = Path(args.baselines)
+    baselines = json.loads(baselines_file.read_text()) if baselines_file.is_file() else {}
+    regressions = []
+    with tempfile.TemporaryDirectory(prefix="cat-micro-benchmark-") as work_dir:
+        install_stand_ins(Path(work_dir), None, [], [])
+        rng = np.random.default_rng(args.seed)
+        benchmarks = get_benchmarks()
+        print(f"{'benchmark':<60} {'time':>11} {'baseline':>11} {'change':>8}")
+        for bank_size in args.banks:
+            for quiz_length in args.lengths:
+                if quiz_length > bank_size:
+                    continue
+                case = BenchmarkCase(bank_size, quiz_length, rng)
+                for name, create_call in benchmarks.items():
+                    key = f"{name}[bank={bank_size},length={quiz_length}]"
+                    if args.filter is not None and args.filter not in key:
+                        continue
+                    seconds = time_call(create_call(case))
+                    baseline = baselines.get(key)
+                    if baseline is None or args.update_baselines:
+                        baselines[key] = seconds
+                        print(f"{key:<60} {format_time(seconds)} {'(new)':>11}")
+                        continue
+                    change = seconds / baseline - 1
+                    failed = change > args.threshold
+                    if failed:
+                        regressions.append(key)
+                    print(f"{key:<60} {format_time(seconds)} {format_time(baseline)} {change * 100:+7.1f}%"
+                          + (" SLOWER" if failed else ""))
+    baselines_file.write_text(json.dumps(baselines, indent=2, sort_keys=True))
+
+    if regressions:
+        print(f"{len(regressions)} benchmarks are more than {args.threshold * 100:.0f}% slower than their baseline: "
+              + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Compares the selectors of the CAT engine with catsim's MaxInfoSelector and UrrySelector: counts the different
+# choices and measures the time per selection. For 3PL items catsim selects the item with the nearest information
+# peak instead of the most informative one, so different choices are expected there.
+# Run from the repository root: python -m benchmarks.selector_benchmark [--items 2000] [--administered 50]
+import argparse
+import time
+import warnings
+
+import numpy as np
+from catsim.cat import generate_item_bank
+from catsim.selection import MaxInfoSelector, UrrySelector
+
+from src.cat.item_bank import ItemBank
+from src.cat.selection import IndexedSelector, get_max_info_selector
+
+
+def time_selector(selector, items: np.ndarray, cases: list):
+    selected = []
+    start = time.perf_counter()
+    for administered_items, est_theta in cases:
+        selected.append(selector.select(items=items, administered_items=administered_items, est_theta=est_theta))
+    return (time.perf_counter() - start) / len(cases), selected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=2000, help="size of the item bank")
+    parser.add_argument("--administered", type=int, default=50, help="number of administered items")
+    parser.add_argument("--selections", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)  # catsim uses the global random state
+    warnings.simplefilter("ignore")  # MaxInfoSelector warns about the missing exposure rate column on every call
+    for item_type, catsim_selector, get_selector in (("1PL", MaxInfoSelector(), get_max_info_selector),
+                                                     ("3PL", MaxInfoSelector(), get_max_info_selector),
+                                                     ("1PL", UrrySelector(),
+                                                      lambda bank: IndexedSelector(bank, by_information=False))):
+        items = generate_item_bank(args.items, item_type)
+        bank = ItemBank(items, list(range(args.items)), [str(i) for i in range(args.items)])
+        cases = [(list(np.random.choice(args.items, args.administered, replace=False)), np.random.normal())
+                 for _ in range(args.selections)]
+        build_start = time.perf_counter()
+        selector = get_selector(bank)
+        build_time = time.perf_counter() - build_start
+
+        catsim_time, catsim_selected = time_selector(catsim_selector, items, cases)
+        selector_time, selected = time_selector(selector, items, cases)
+
+        mismatches = sum(a != b for a, b in zip(catsim_selected, selected))
+        print(f"{catsim_selector} ({item_type}, {args.items} items, {args.administered} administered)")
+        print(f"  catsim:  {catsim_time * 1e6:9.1f} us per selection")
+        print(f"  {selector}: {selector_time * 1e6:9.1f} us per selection ({build_time * 1000:.2f} ms to build)")
+        print(f"  speedup: {catsim_time / selector_time:9.1f}x, different choices: {mismatches}/{args.selections}")
+
+
+if __name__ == "__main__":
+    main()
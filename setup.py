@@ -27,7 +27,8 @@ class StartCommand(Command):
         if not Path(config.log_settings["ce_logfile"]).is_file():  # if logfile does not already exist
             with open(config.log_settings["ce_logfile"], "w") as logfile:  # create new logfile
                 writer = csv.writer(logfile, delimiter=config.log_settings["csv_delimiter"])
-                writer.writerow(config.log_settings["ce_logfile_columns"])  # write header to logfile
+                from src.cat.cat_engine_logging import LOG_FILE_COLUMNS
+                writer.writerow(LOG_FILE_COLUMNS)  # write header to logfile
                 #writer.writerow(["2000-01-01 00:00:00", "<--- LAST INSERTED INTO DB"])
         # run application
         import uvicorn
@@ -54,6 +55,189 @@ class CreateDbCommand(Command):
         Base.metadata.create_all(engine)
 
 
+class CreateNeo4jIndexesCommand(Command):
+
+    """Create the Neo4j indexes used by the CAT engine."""
+
+    description = 'create the neo4j indexes'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.neo4j_connector import create_indexes, close_graphdb
+        create_indexes()
+        close_graphdb()
+
+
+class MigrateQuizIdsCommand(Command):
+
+    """Move the ids of the legacy quizIds list into the quiz id set."""
+
+    description = 'migrate the quiz id list to the quiz id set'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.quiz_state import migrate_quiz_ids
+        print(f"Migrated {migrate_quiz_ids()} quiz ids")
+
+
+class MigrateLegacyQuizzesCommand(Command):
+
+    """Move the quizzes stored with one key per field into quiz state hashes."""
+
+    description = 'migrate the quizzes stored with one key per field to quiz state hashes'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.quiz_state import migrate_quiz_ids, migrate_legacy_quizzes
+        print(f"Migrated {migrate_quiz_ids()} quiz ids")
+        print(f"Migrated {migrate_legacy_quizzes()} quizzes")
+
+
+class CalibrationWorkerCommand(Command):
+
+    """Start a worker calibrating the question difficulties of finished quizzes."""
+
+    description = 'start a calibration worker'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.calibration_worker import run_calibration_worker
+        run_calibration_worker()
+
+
+class SweepQuizzesCommand(Command):
+
+    """Remove the ids of expired quizzes from the quiz id set continuously."""
+
+    description = 'remove expired quizzes from the quiz id set every ten minutes'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.quiz_state import run_quiz_sweeper
+        run_quiz_sweeper()
+
+
+class IngestLogsCommand(Command):
+
+    """Insert the logfile into the log database continuously."""
+
+    description = 'insert new logs into the log database every minute'
+    user_options = []
+
+    def initialize_options(self) -> None:
+        pass
+
+    def finalize_options(self) -> None:
+        pass
+
+    def run(self) -> None:
+        from src.cat.cat_engine_logging import run_log_ingester
+        run_log_ingester()
+
+
+class ExportLogsCommand(Command):
+
+    """Export the question logs added since the last export to Parquet files (needs pyarrow)."""
+
+    description = 'export the question logs to parquet files'
+    user_options = [('output-dir=', 'o', 'directory of the exported files (default: export next to the logfile)')]
+
+    def initialize_options(self) -> None:
+        self.output_dir = None
+
+    def finalize_options(self) -> None:
+        if self.output_dir is None:
+            self.output_dir = str(Path(config.log_settings["ce_logfile"]).parent / "export")
+
+    def run(self) -> None:
+        from src.cat.log_export import export_question_logs
+        print(f"Exported {export_question_logs(self.output_dir)} question logs to {self.output_dir}")
+
+
+class SimulateCommand(Command):
+
+    """Simulate adaptive quizzes of a topic to compare stopping rules."""
+
+    description = 'simulate adaptive quizzes of a topic'
+    user_options = [
+        ('topic=', 't', 'id of the topic whose item bank is used'),
+        ('examinees=', 'n', 'number of simulated examinees (default: 10000)'),
+        ('min-accuracy=', None, 'comma separated values of minMeasurementAccuracy (default: config)'),
+        ('max-questions=', None, 'comma separated values of maxNumberOfQuestions (default: config)'),
+        ('selector=', None, 'question selector (default: config)'),
+        ('estimator=', None, 'competency estimator (default: config)'),
+        ('theta-mean=', None, 'mean competency of the examinees (default: mean difficulty)'),
+        ('theta-sd=', None, 'standard deviation of the competencies (default: sd of the difficulties)'),
+        ('workers=', 'w', 'number of processes (default: number of CPUs)'),
+        ('seed=', None, 'random seed (default: 0)'),
+        ('output=', 'o', 'JSON file for the results (default: simulation_<topic>.json)'),
+    ]
+
+    def initialize_options(self) -> None:
+        self.topic = None
+        self.examinees = 10000
+        self.min_accuracy = str(config.defaultAdaptiveQuiz["minMeasurementAccuracy"])
+        self.max_questions = str(config.defaultAdaptiveQuiz["maxNumberOfQuestions"])
+        self.selector = None
+        self.estimator = None
+        self.theta_mean = None
+        self.theta_sd = None
+        self.workers = None
+        self.seed = 0
+        self.output = None
+
+    def finalize_options(self) -> None:
+        if self.topic is None:
+            self.topic = config.defaultAdaptiveQuiz["topicId"]
+        self.examinees = int(self.examinees)
+        self.min_accuracy = [float(value) for value in str(self.min_accuracy).split(",")]
+        self.max_questions = [int(value) for value in str(self.max_questions).split(",")]
+        self.theta_mean = float(self.theta_mean) if self.theta_mean is not None else None
+        self.theta_sd = float(self.theta_sd) if self.theta_sd is not None else None
+        self.workers = int(self.workers) if self.workers is not None else None
+        self.seed = int(self.seed)
+        if self.output is None:
+            self.output = f"simulation_{self.topic}.json"
+
+    def run(self) -> None:
+        from src.cat.simulation import simulate_topic, print_simulation_report, write_simulation_report
+        report = simulate_topic(self.topic, self.examinees, self.min_accuracy, self.max_questions, self.selector,
+                                self.estimator, self.theta_mean, self.theta_sd, self.workers, self.seed)
+        print_simulation_report(report)
+        write_simulation_report(report, self.output)
+        print(f"Results written to {self.output}")
+
+
 class InitDatabase(Command):
 
     """
@@ -127,6 +311,14 @@ setup(
     cmdclass={
         'start': StartCommand,
         'create_database': CreateDbCommand,
+        'create_neo4j_indexes': CreateNeo4jIndexesCommand,
+        'migrate_quiz_ids': MigrateQuizIdsCommand,
+        'migrate_legacy_quizzes': MigrateLegacyQuizzesCommand,
+        'calibration_worker': CalibrationWorkerCommand,
+        'sweep_quizzes': SweepQuizzesCommand,
+        'ingest_logs': IngestLogsCommand,
+        'export_logs': ExportLogsCommand,
+        'simulate': SimulateCommand,
         'init_db': InitDatabase,
         'migrate': MigrateCommand,
         'upgrade': UpgradeCommand
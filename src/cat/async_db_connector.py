@@ -0,0 +1,44 @@
+import redis
+import redis.asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.cat.db_connector import r, engine
+from src.cat.db_session import get_pool_settings
+
+# connection settings taken over from the blocking Redis client
+REDIS_CONNECTION_SETTINGS = ["host", "port", "db", "username", "password", "socket_timeout", "socket_connect_timeout",
+                             "socket_keepalive", "encoding", "encoding_errors", "decode_responses", "retry_on_timeout",
+                             "health_check_interval", "client_name", "ssl_keyfile", "ssl_certfile", "ssl_cert_reqs",
+                             "ssl_ca_certs", "ssl_check_hostname"]
+
+# async drivers for the dialects of the blocking SQLAlchemy engine
+ASYNC_DB_DRIVERS = {
+    "mysql": "aiomysql",
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+# creates an asyncio Redis client connecting to the same server as the blocking client
+def create_async_redis():
+    connection_kwargs = {setting: value for setting, value in r.connection_pool.connection_kwargs.items()
+                         if setting in REDIS_CONNECTION_SETTINGS}
+    if issubclass(r.connection_pool.connection_class, redis.SSLConnection):
+        connection_class = redis.asyncio.connection.SSLConnection
+    else:
+        connection_class = redis.asyncio.connection.Connection
+    return redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool(connection_class=connection_class,
+                                                                            **connection_kwargs))
+
+
+# creates an async SQLAlchemy engine connecting to the same database as the blocking engine
+def create_async_db_engine():
+    backend = engine.url.get_backend_name()
+    return create_async_engine(engine.url.set(drivername=backend + "+" + ASYNC_DB_DRIVERS[backend]),
+                               **get_pool_settings(backend))
+
+
+ar = create_async_redis()
+async_engine = create_async_db_engine()
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
@@ -0,0 +1,202 @@
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select
+
+import config
+from src.cat.cat_engine_logging import CELog
+from src.cat.db_session import bulk_update
+from src.models.sqlalchemy_models import CalibratedQuiz, Difficulty, QuestionLog
+
+# stream with the calibration jobs of finished quizzes, processed by src.cat.calibration_worker
+CALIBRATION_STREAM_KEY = "calibrationJobs"
+CALIBRATION_GROUP = "calibrationWorkers"
+
+# jobs failing this many times are moved to the dead letter stream instead of being retried again
+CALIBRATION_MAX_DELIVERIES = 5
+CALIBRATION_DEAD_LETTER_KEY = "calibrationJobsDead"
+
+
+# class holding everything needed to calibrate the questions of a finished quiz, a snapshot taken when the quiz
+# finished, so the job does not depend on the quiz state still existing when it is processed
+class CalibrationJob:
+    def __init__(self, quiz_id: int, question_ids: list, difficulties: list, answers: list, student_score: float,
+                 denominator: float, update_rate: float):
+        self.quiz_id = quiz_id
+        self.question_ids = question_ids
+        self.difficulties = difficulties  # difficulties of the questions when the quiz was created
+        self.answers = answers  # given answers as boolean values
+        self.student_score = student_score
+        self.denominator = denominator
+        self.update_rate = update_rate
+
+    # returns the job as stream entry
+    def to_fields(self):
+        return {
+            "quizId": self.quiz_id,
+            "questionIds": json.dumps(self.question_ids),
+            "difficulties": json.dumps(self.difficulties),
+            "answers": json.dumps(self.answers),
+            "studentScore": self.student_score,
+            "denominator": self.denominator,
+            "updateRate": self.update_rate,
+        }
+
+    # creates the job from a stream entry
+    @classmethod
+    def from_fields(cls, fields: dict):
+        fields = {field.decode("utf-8"): value for field, value in fields.items()}
+        return cls(int(fields["quizId"]),
+                   json.loads(fields["questionIds"]),
+                   json.loads(fields["difficulties"]),
+                   json.loads(fields["answers"]),
+                   float(fields["studentScore"]),
+                   float(fields["denominator"]),
+                   float(fields["updateRate"]))
+
+
+# class used as a structure for matching question_ids, difficulties and given answers
+class Question:
+    def __init__(self, question_id, initial_difficulty, answer):
+        self.question_id = question_id
+        self.initial_difficulty = initial_difficulty
+        self.calibrated_difficulty = None  # difficulty after all jobs applied together were applied
+        self.difficulty_delta = None  # change of the difficulty by this job, before it is limited to 0
+        self.answer = answer
+
+
+# creates the calibration job of a finished quiz with the global calibration parameters read from Redis (None if
+# they were never set, then the defaults of the config are used)
+def create_calibration_job(state, global_denominator: bytes, global_update_rate: bytes):
+    item_bank = state.get_item_bank()
+    administered_items = state.administered_items
+
+    # pylint: disable=invalid-name
+    # D: denominator
+    # MST-21 workaround
+    d = float(global_denominator or 0) if float(global_denominator or 0) != 0 else config.calibration[
+        "denominator"]
+
+    # K: update rate
+    # MST-21 workaround
+    k = float(global_update_rate or 0) if float(global_update_rate or 0) != 0 else config.calibration[
+        "update_rate"]
+
+    return CalibrationJob(state.quiz_id,
+                          [item_bank.question_ids[item_index] for item_index in administered_items],
+                          [float(item_bank.items[item_index, 1]) for item_index in administered_items],
+                          [bool(answer) for answer in state.get_responses()],
+                          # rA: score of the student (proficiency level is defined when first creating the quiz)
+                          state["inputProficiencyLevel"],
+                          d, k)
+
+
+# adds the job to the calibration stream in the given pipeline, e.g. in the transaction saving the finished quiz
+def queue_calibration_job(pipe, job: CalibrationJob):
+    pipe.xadd(CALIBRATION_STREAM_KEY, job.to_fields())
+
+
+# bundles each question_id of a job with its difficulty and the given answer into one Question object
+def match_administered_items(job: CalibrationJob):
+    return [Question(question_id, difficulty, answer)
+            for question_id, difficulty, answer in zip(job.question_ids, job.difficulties, job.answers)]
+
+
+# computes the difficulty changes of all questions of a job
+def calibrate_items(job: CalibrationJob):
+    matched_items = match_administered_items(job)
+
+    # These parameters do not change during a quiz:
+    r_a = job.student_score
+    d = job.denominator
+    k = job.update_rate
+
+    # assign each question a newly calibrated difficulty
+    for matched_item in matched_items:
+        # rB: item difficulty
+        r_b = matched_item.initial_difficulty
+
+        # EAB: probability of answering question correctly
+        eab = (10 ** (r_a - r_b) / d) / (1 + (10 ** (r_a - r_b) / d))
+
+        # pylint: disable=invalid-name
+        # S: answer
+        s = matched_item.answer
+
+        # r'B - rB: change of the item difficulty, the sum of the changes of all applied jobs is added to the
+        # current difficulty (see apply_calibration_jobs)
+        matched_item.difficulty_delta = - k * (s - eab)
+
+    return matched_items
+
+
+# returns the logs of the calibrated questions of a job: the difficulty when the quiz was created and the difficulty
+# the question got when the job was applied
+def create_question_logs(job: CalibrationJob, calibrated_items: list):
+    return [CELog(quiz_id=job.quiz_id,
+                  question_id=calibrated_item.question_id,
+                  answer=calibrated_item.answer,
+                  start_difficulty=calibrated_item.initial_difficulty,
+                  end_difficulty=calibrated_item.calibrated_difficulty,
+                  denominator=job.denominator,
+                  update_rate=job.update_rate,
+                  student_score=job.student_score)
+            for calibrated_item in calibrated_items]
+
+
+# sums up the difficulty changes of the questions over all given jobs
+def aggregate_difficulty_deltas(calibrated_items: list):
+    difficulty_deltas = defaultdict(float)
+    for calibrated_item in calibrated_items:
+        difficulty_deltas[calibrated_item.question_id] += calibrated_item.difficulty_delta
+    return difficulty_deltas
+
+
+# Applies the calibration jobs in the session's transaction (the caller commits): the changes of all jobs are summed
+# up per question and added to the current difficulties, so the number of written rows depends on the number of
+# distinct questions and not on the number of quizzes, and concurrent quizzes cannot overwrite each other's changes.
+# Jobs that were already applied are skipped. Returns the applied jobs and the question logs of their items, which
+# show the difficulties the questions got here.
+def apply_calibration_jobs(session, jobs: list):
+    already_applied = set(session.execute(
+        select(CalibratedQuiz.quiz_id).where(CalibratedQuiz.quiz_id.in_([job.quiz_id for job in jobs]))).scalars())
+    new_jobs = {}
+    for job in jobs:
+        if job.quiz_id not in already_applied:
+            new_jobs.setdefault(job.quiz_id, job)  # a job can be in the stream twice if a worker re-added it
+    calibrated_items_of_jobs = [(job, calibrate_items(job)) for job in new_jobs.values()]
+    difficulty_deltas = aggregate_difficulty_deltas(
+        [calibrated_item for _, calibrated_items in calibrated_items_of_jobs for calibrated_item in calibrated_items])
+    applied_difficulties = {}
+    if difficulty_deltas:
+        # lock the rows in a fixed order, so concurrent workers cannot deadlock
+        rows = session.execute(
+            select(Difficulty.question_id, Difficulty.topic_id, Difficulty.difficulty)
+            .where(Difficulty.question_id.in_(difficulty_deltas))
+            .order_by(Difficulty.question_id, Difficulty.topic_id)
+            .with_for_update()).all()
+        flush_time = datetime.now()
+        new_difficulties = []
+        for question_id, topic_id, difficulty in rows:
+            new_difficulty = max(float(difficulty) + difficulty_deltas[question_id], 0)  # cannot drop below 0
+            new_difficulties.append({"question_id": question_id, "topic_id": topic_id, "difficulty": new_difficulty})
+            applied_difficulties[question_id] = new_difficulty
+            session.add(QuestionLog(log_time=flush_time, question_id=question_id,
+                                    start_difficulty=difficulty, end_difficulty=new_difficulty))
+        if new_difficulties:
+            update_item_difficulties(session, new_difficulties)
+    session.add_all([CalibratedQuiz(quiz_id=quiz_id, calibration_time=datetime.now()) for quiz_id in new_jobs])
+
+    question_logs = []
+    for job, calibrated_items in calibrated_items_of_jobs:
+        for calibrated_item in calibrated_items:
+            calibrated_item.calibrated_difficulty = applied_difficulties.get(calibrated_item.question_id)
+        question_logs.extend(create_question_logs(job, calibrated_items))
+    return list(new_jobs.values()), question_logs
+
+
+# updates the item difficulties in one executemany statement, new_difficulties contains dicts with question_id,
+# topic_id and difficulty
+def update_item_difficulties(session, new_difficulties: list):
+    bulk_update(session, Difficulty, new_difficulties, ["question_id", "topic_id"])
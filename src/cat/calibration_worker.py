@@ -0,0 +1,150 @@
+import logging
+import os
+import socket
+import time
+
+from redis.exceptions import ResponseError
+
+from src.cat.calibration import CalibrationJob, apply_calibration_jobs, CALIBRATION_STREAM_KEY, CALIBRATION_GROUP, \
+    CALIBRATION_MAX_DELIVERIES, CALIBRATION_DEAD_LETTER_KEY
+from src.cat.cat_engine import log
+from src.cat.db_connector import r
+from src.cat.db_session import session_scope
+from src.cat.metrics import queue_calibration_metrics
+
+# Calibration jobs are read from the stream in a consumer group. A job stays pending until it has been applied and
+# acknowledged, jobs of a crashed worker are claimed by another worker after CALIBRATION_CLAIM_IDLE_TIME. Applying
+# a job twice is prevented by the CalibratedQuiz row written in the same transaction as the new difficulties.
+# The jobs arriving within CALIBRATION_FLUSH_INTERVAL are applied together in one flush.
+
+# maximum number of jobs per flush and milliseconds to wait for new jobs
+CALIBRATION_READ_COUNT = 500
+CALIBRATION_BLOCK_TIME = 5000
+
+# seconds jobs are collected after the first one arrived, before they are applied together
+CALIBRATION_FLUSH_INTERVAL = 1.0
+
+# milliseconds a job can stay unacknowledged before it is claimed by another worker
+CALIBRATION_CLAIM_IDLE_TIME = 60 * 1000
+
+worker_logger = logging.getLogger(__name__)
+
+
+# creates the consumer group (and the stream) if it does not exist yet
+def create_calibration_group():
+    try:
+        r.xgroup_create(CALIBRATION_STREAM_KEY, CALIBRATION_GROUP, id="0", mkstream=True)
+    except ResponseError as error:
+        if "BUSYGROUP" not in str(error):  # the group already exists
+            raise
+
+
+def get_consumer_name():
+    return socket.gethostname() + "_" + str(os.getpid())
+
+
+# applies the calibration jobs in one transaction, returns the applied jobs (jobs applied before are skipped)
+def flush_calibration_jobs(jobs: list):
+    start = time.perf_counter()
+    with session_scope() as session:
+        applied_jobs, question_logs = apply_calibration_jobs(session, jobs)
+    pipe = r.pipeline(transaction=False)
+    queue_calibration_metrics(pipe, len(applied_jobs), time.perf_counter() - start)
+    pipe.execute()
+
+    # log changes
+    for question_log in question_logs:
+        log(question_log)
+    return applied_jobs
+
+
+# applies and acknowledges the given stream entries, failed jobs stay pending and are retried later
+def process_calibration_entries(entries: list):
+    jobs = {}  # entry id -> job
+    for entry_id, fields in entries:
+        if not fields:  # deleted from the stream while pending
+            acknowledge_calibration_entries([entry_id])
+            continue
+        try:
+            jobs[entry_id] = CalibrationJob.from_fields(fields)
+        except Exception:
+            worker_logger.exception("Calibration job %s is invalid", entry_id)
+    if not jobs:
+        return
+    try:
+        flush_calibration_jobs(list(jobs.values()))
+        acknowledge_calibration_entries(list(jobs))
+    except Exception:
+        # apply the jobs one by one, so a failing job does not hold back the others
+        worker_logger.exception("Calibration flush of %d jobs failed, retrying them one by one", len(jobs))
+        for entry_id, job in jobs.items():
+            try:
+                flush_calibration_jobs([job])
+            except Exception:
+                worker_logger.exception("Calibration job %s failed", entry_id)
+                continue
+            acknowledge_calibration_entries([entry_id])
+
+
+def acknowledge_calibration_entries(entry_ids: list):
+    pipe = r.pipeline(transaction=True)
+    pipe.xack(CALIBRATION_STREAM_KEY, CALIBRATION_GROUP, *entry_ids)
+    pipe.xdel(CALIBRATION_STREAM_KEY, *entry_ids)
+    pipe.execute()
+
+
+# claims the jobs left unacknowledged by crashed (or failing) workers, jobs delivered too often are moved to the
+# dead letter stream
+def claim_stale_calibration_entries(consumer: str):
+    pending = r.xpending_range(CALIBRATION_STREAM_KEY, CALIBRATION_GROUP, min="-", max="+",
+                               count=CALIBRATION_READ_COUNT, idle=CALIBRATION_CLAIM_IDLE_TIME)
+    retry_ids = []
+    for pending_entry in pending:
+        if pending_entry["times_delivered"] < CALIBRATION_MAX_DELIVERIES:
+            retry_ids.append(pending_entry["message_id"])
+            continue
+        for entry_id, fields in r.xrange(CALIBRATION_STREAM_KEY, pending_entry["message_id"],
+                                         pending_entry["message_id"]):
+            r.xadd(CALIBRATION_DEAD_LETTER_KEY, fields)
+            worker_logger.error("Calibration job %s moved to %s", entry_id, CALIBRATION_DEAD_LETTER_KEY)
+        acknowledge_calibration_entries([pending_entry["message_id"]])
+    if not retry_ids:
+        return []
+    return r.xclaim(CALIBRATION_STREAM_KEY, CALIBRATION_GROUP, consumer, min_idle_time=CALIBRATION_CLAIM_IDLE_TIME,
+                    message_ids=retry_ids)
+
+
+# reads the jobs of one flush: waits up to block milliseconds for the first job (does not wait if block is None),
+# then collects jobs for CALIBRATION_FLUSH_INTERVAL seconds or until CALIBRATION_READ_COUNT jobs were read
+def read_calibration_entries(consumer: str, block: int = None):
+    entries = claim_stale_calibration_entries(consumer)
+    deadline = time.monotonic() + CALIBRATION_FLUSH_INTERVAL if entries else None
+    while len(entries) < CALIBRATION_READ_COUNT:
+        if deadline is not None:
+            block = int((deadline - time.monotonic()) * 1000)
+            if block <= 0:
+                break
+        response = r.xreadgroup(CALIBRATION_GROUP, consumer, {CALIBRATION_STREAM_KEY: ">"},
+                                count=CALIBRATION_READ_COUNT - len(entries), block=block)
+        stream_entries = [entry for _, entries_of_stream in response or [] for entry in entries_of_stream]
+        if not stream_entries and deadline is None:
+            break
+        entries.extend(stream_entries)
+        if deadline is None:
+            deadline = time.monotonic() + CALIBRATION_FLUSH_INTERVAL
+    return entries
+
+
+# processes the jobs of one flush, returns the number of processed entries
+def process_available_calibration_jobs(consumer: str, block: int = None):
+    entries = read_calibration_entries(consumer, block)
+    process_calibration_entries(entries)
+    return len(entries)
+
+
+# runs the calibration worker until it is stopped
+def run_calibration_worker(consumer: str = None):
+    consumer = consumer if consumer is not None else get_consumer_name()
+    create_calibration_group()
+    while True:
+        process_available_calibration_jobs(consumer, block=CALIBRATION_BLOCK_TIME)
@@ -1,19 +1,44 @@
+import atexit
 import csv
+import heapq
+import logging
+import os
+import queue
+import socket
+import threading
+import time
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select
 
 import config
-from src.cat.db_connector import engine
-from src.models.sqlalchemy_models import LastLogDate, QuizLog, QuestionLog
+from src.cat.db_session import bulk_insert, bulk_update, bulk_upsert, session_scope
+from src.models.sqlalchemy_models import LastLogDate, LogCheckpoint, QuizLog, QuestionLog
+
+ingester_logger = logging.getLogger(__name__)
+
+# columns of the logfile: the configured columns and the sequence number of the log entry
+LOG_FILE_COLUMNS = config.log_settings["ce_logfile_columns"] + (
+    [] if "seq" in config.log_settings["ce_logfile_columns"] else ["seq"])
+
+# maximum number of log lines buffered before they are written to the logfile
+LOG_BUFFER_SIZE = 1000
+
+# every process writes its own shard of the logfile, a new shard is started when it reaches the size or age limit
+LOG_SHARD_MAX_BYTES = 64 * 1024 * 1024
+LOG_SHARD_MAX_AGE = 24 * 60 * 60
+
+# seconds a shard of a process that cannot be checked (on another host) must be unchanged before it is retired
+LOG_SHARD_RETIRE_IDLE_TIME = LOG_SHARD_MAX_AGE
 
 
 # class for cat_engine logging
 class CELog:
     def __init__(self, quiz_id=None, log_time=None, log_id=None, question_id=None, quiz_start_time=None,
                  question_start_time=None, quiz_end_time=None, answer=None, start_difficulty=None, end_difficulty=None,
-                 denominator=None, update_rate=None, student_score=None):
+                 denominator=None, update_rate=None, student_score=None, seq=None):
         self.log_id = log_id
         self.log_time = log_time
         self.quiz_id = quiz_id
@@ -27,6 +52,7 @@ class CELog:
         self.denominator = denominator
         self.update_rate = update_rate
         self.student_score = student_score
+        self.seq = seq  # orders the log entries, set when the entry is logged
 
     def get_log_representation(self):
         delimiter = config.log_settings["csv_delimiter"]
@@ -41,92 +67,447 @@ class CELog:
             str(self.end_difficulty),
             str(self.denominator),
             str(self.update_rate),
-            str(self.student_score)
+            str(self.student_score),
+            str(self.seq)
         ])
 
 
-# inserts logs from logfile into db and returns date of last log inserted
-def log_to_database():
-    log_file = Path("../cat-module/logfiles/ce_logfile.csv")
-    with open(log_file, "r", encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file, delimiter=config.log_settings["csv_delimiter"])
+# class generating increasing sequence numbers for log entries: microseconds since the epoch, increased by one if
+# several entries are logged in the same microsecond
+class LogSequence:
+    def __init__(self):
+        self._last_seq = 0
+        self._lock = threading.Lock()
+
+    def next_seq(self):
+        with self._lock:
+            self._last_seq = max(self._last_seq + 1, time.time_ns() // 1000)
+            return self._last_seq
+
+
+# --------------- Log writer ---------------
+
+# Log records are put on a queue by the request threads and written to the logfile by a background thread
+# (QueueListener). The lines are buffered and written at once when the queue is empty or the buffer is full.
+# Each process writes to its own shard files next to the configured logfile (<name>.<host>-<pid>-<seq>.csv), so
+# processes never share a file. The log ingestion merges the shards by sequence number.
+
+# file handler writing the buffered lines with one write call
+class BufferedFileHandler(logging.FileHandler):
+    def __init__(self, filename, buffer_size: int = LOG_BUFFER_SIZE):
+        super().__init__(filename)
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.buffer.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write("".join(self.buffer))
+                self.buffer = []
+            super().flush()
+        finally:
+            self.release()
+
+
+# queue listener flushing its handlers whenever the queue has been emptied
+class BufferedQueueListener(QueueListener):
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+# buffered file handler writing to the shard files of this process, each starting with the header
+class ShardFileHandler(BufferedFileHandler):
+    def __init__(self, log_file: str, max_bytes: int = LOG_SHARD_MAX_BYTES, max_age: float = LOG_SHARD_MAX_AGE):
+        self.log_file = Path(log_file)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.opened_at = None
+        super().__init__(get_log_shard_path(self.log_file))
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:  # new shard
+            stream.write(config.log_settings["csv_delimiter"].join(LOG_FILE_COLUMNS) + self.terminator)
+        self.opened_at = time.monotonic()
+        return stream
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream is not None and not os.path.exists(self.baseFilename) \
+                    and os.path.isdir(os.path.dirname(self.baseFilename)):  # retired while idle
+                self.rotate()
+            super().flush()
+            if self.stream is not None and (self.stream.tell() >= self.max_bytes
+                                            or time.monotonic() - self.opened_at >= self.max_age):
+                self.rotate()
+        finally:
+            self.release()
+
+    # continues in a new shard, the old one is retired by the log ingestion once it has been inserted
+    def rotate(self):
+        self.stream.close()
+        self.baseFilename = os.path.abspath(get_log_shard_path(self.log_file))
+        self.stream = self._open()
+
+
+# returns the path of a new shard of the logfile for this process
+def get_log_shard_path(log_file: Path):
+    return log_file.with_name(f"{log_file.stem}.{socket.gethostname()}-{os.getpid()}-{time.time_ns() // 1000}"
+                              f"{log_file.suffix}")
+
+
+# returns the host, pid and start time (microseconds) of the process writing a shard of the logfile
+def get_log_shard_writer(log_file: Path, shard: Path):
+    host, pid, started = shard.name[len(log_file.stem) + 1:len(shard.name) - len(log_file.suffix)].rsplit("-", 2)
+    return host, int(pid), int(started)
+
+
+# returns the shards of the logfile (and the logfile itself, written before there were shards)
+def get_log_files(log_file: Path):
+    log_files = sorted(log_file.parent.glob(f"{log_file.stem}.*{log_file.suffix}"))
+    return ([log_file] if log_file.is_file() else []) + log_files
+
+
+def is_process_running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # running as another user
+        return True
+    return True
+
+
+# returns the shards of the logfile no process writes to any more: its writer continued in a newer shard or is not
+# running any more (checked for processes on this host only, shards of other hosts must be unchanged for
+# LOG_SHARD_RETIRE_IDLE_TIME)
+def get_closed_log_shards(log_file: Path, shards: list):
+    writers = {}
+    for shard in shards:
+        try:
+            writers[shard] = get_log_shard_writer(log_file, shard)
+        except ValueError:  # the logfile itself or not a shard
+            continue
+    latest_shards = {}  # (host, pid) -> start time of its newest shard
+    for host, pid, started in writers.values():
+        latest_shards[host, pid] = max(started, latest_shards.get((host, pid), started))
+    closed_shards = []
+    for shard, (host, pid, started) in writers.items():
+        try:
+            if started < latest_shards[host, pid] or (host == socket.gethostname() and not is_process_running(pid)) \
+                    or time.time() - shard.stat().st_mtime >= LOG_SHARD_RETIRE_IDLE_TIME:
+                closed_shards.append(shard)
+        except FileNotFoundError:  # retired by another ingester
+            continue
+    return closed_shards
+
+
+# starts the background thread writing the log records to shard files of the logfile, returns the handler to add to
+# the logger
+def start_log_writer(log_file: str):
+    file_handler = ShardFileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d;%(message)s', '%Y-%m-%d %H:%M:%S'))
+    log_queue = queue.SimpleQueue()
+    listener = BufferedQueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(stop_log_writer, listener)
+    return QueueHandler(log_queue)
+
+
+# writes the remaining log records and stops the background thread
+def stop_log_writer(listener: QueueListener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+# --------------- Log ingestion ---------------
+
+# Logs are inserted incrementally: the byte offset (and inode) of each logfile shard up to which the logs were
+# inserted is stored in LogCheckpoints, updated in the same transaction as the logs of each chunk. The lines of all
+# shards are merged by sequence number, so e.g. the start of a quiz logged by one process is inserted before its
+# answers logged by another one. Only complete lines older than LOG_INGEST_GRACE_PERIOD are read, so lines still
+# buffered by a process cannot be overtaken and lines still being written are inserted by the next run.
 
-        session = sessionmaker(bind=engine)()
+# number of logfile lines inserted per transaction
+LOG_INGEST_CHUNK_LINES = 5000
 
-        # get the last date logs were inserted into the db
-        last_db_log_date = session.query(LastLogDate).first().date
+# seconds between two runs of the log ingester
+LOG_INGEST_INTERVAL = 60
 
-        # iterate through logfile lines
-        for line in csv_reader:
-            file_log_date = line["log_time"]
-            # compare last db log (insertion) date against log time for logfile line:
-            # skips logfile line if line has already been inserted into db
-            if datetime.strptime(file_log_date, "%Y-%m-%d %H:%M:%S.%f") <= last_db_log_date:
+# seconds a log line must be old before it is inserted (its sequence number is the log time in microseconds)
+LOG_INGEST_GRACE_PERIOD = 10
+
+log_ingest_lock = threading.Lock()  # one ingestion per process, concurrent processes are serialized by the db
+
+
+QUESTION_DETAIL_COLUMNS = ["answer", "start_difficulty", "end_difficulty", "denominator", "update_rate",
+                           "student_score"]
+
+
+# parsers for the fields of a logfile line, missing values are logged as "None"
+def parse_log_int(value: str):
+    return int(value) if value != "None" else None
+
+
+def parse_log_float(value: str):
+    return float(value) if value != "None" else None
+
+
+def parse_log_answer(value: str):  # answers are logged as boolean values
+    if value == "None":
+        return None
+    return 1 if value == "True" else 0 if value == "False" else int(float(value))
+
+
+def parse_log_time(value: str):
+    return datetime.fromisoformat(value) if value != "None" else None
+
+
+# returns the remaining question log details of a logfile line
+def parse_question_details(line: dict):
+    return {
+        "answer": parse_log_answer(line["answer"]),
+        "start_difficulty": parse_log_float(line["start_difficulty"]),
+        "end_difficulty": parse_log_float(line["end_difficulty"]),
+        "denominator": parse_log_float(line["denominator"]),
+        "update_rate": parse_log_float(line["update_rate"]),
+        "student_score": parse_log_float(line["student_score"]),
+    }
+
+
+# yields (seq, file_index, offset after the line, line) for the complete lines of a logfile starting at offset
+def read_log_lines(file_index: int, log_file: Path, offset: int):
+    delimiter = config.log_settings["csv_delimiter"]
+    with open(log_file, "rb") as binary_file:
+        binary_file.seek(offset)
+        for binary_line in binary_file:
+            if not binary_line.endswith(b"\n"):  # line not completely written yet
+                return
+            offset += len(binary_line)
+            fields = next(csv.reader([binary_line.decode("utf-8")], delimiter=delimiter), None)
+            if not fields or fields[0] == LOG_FILE_COLUMNS[0]:  # empty line or header
+                continue
+            line = dict(zip(LOG_FILE_COLUMNS, fields))
+            # lines written before the seq column was added are ordered by their log time
+            seq = int(line["seq"]) if "seq" in line else int(parse_log_time(line["log_time"]).timestamp() * 1000000)
+            yield seq, file_index, offset, line
+
+
+# class collecting the db changes of the lines of one chunk, so they can be written with a few bulk statements
+class LogChunk:
+    def __init__(self):
+        self.quiz_logs = {}  # quiz_id -> values of new QuizLogs
+        self.question_logs = {}  # (quiz_id, question_id) -> values of new QuestionLogs
+        self.quiz_end_times = {}  # quiz_id -> quiz_end_time of QuizLogs inserted before
+        self.question_details = {}  # (quiz_id, question_id) -> remaining details of QuestionLogs inserted before
+        self.last_log_time = None
+
+    # (usual logging order: quiz_start_time > question_start_time > rest of question > quiz_end_time)
+    def add_line(self, line: dict):
+        log_time = parse_log_time(line["log_time"])
+        quiz_id = parse_log_int(line["quiz_id"])
+        question_id = parse_log_int(line["question_id"])
+        # check which "type" of logfile line it is
+        if line["quiz_start_time"] != "None":  # if log with quiz_start_time is encountered
+            # insert new quiz log entry with only quiz_id and quiz_start_time (quiz_end_time is None/0)
+            self.quiz_logs[quiz_id] = {
+                "quiz_id": quiz_id,
+                "quiz_start_time": parse_log_time(line["quiz_start_time"]),
+                "quiz_end_time": parse_log_time(line["quiz_end_time"]),
+            }
+        elif line["question_start_time"] != "None":  # if log with question_start_time is encountered
+            # insert new question log entry with only log_time, quiz_id, question_id
+            # and question_start_time (the rest is None/0)
+            self.question_logs[(quiz_id, question_id)] = dict({
+                "log_time": log_time,
+                "quiz_id": quiz_id,
+                "question_id": question_id,
+                "question_start_time": parse_log_time(line["question_start_time"]),
+            }, **parse_question_details(line))
+        elif line["quiz_end_time"] != "None":  # if log with quiz_end_time is encountered
+            # update quiz log with quiz end time
+            quiz_end_time = parse_log_time(line["quiz_end_time"])
+            if quiz_id in self.quiz_logs:
+                self.quiz_logs[quiz_id]["quiz_end_time"] = quiz_end_time
+            else:
+                self.quiz_end_times[quiz_id] = quiz_end_time
+        else:  # any other log, these logs contain the rest of question log details
+            # update question log of the quiz with remaining question log details
+            details = parse_question_details(line)
+            if (quiz_id, question_id) in self.question_logs:
+                self.question_logs[(quiz_id, question_id)].update(details)
+            else:
+                self.question_details[(quiz_id, question_id)] = details
+        self.last_log_time = log_time
+
+    # moves the new question logs which were already inserted (e.g. before a checkpoint reset) to the details
+    # updates, so lines read again do not insert a question twice
+    def skip_inserted_question_logs(self, session):
+        quiz_ids = {quiz_id for quiz_id, _ in self.question_logs if quiz_id is not None}
+        if not quiz_ids:
+            return
+        inserted = set(session.execute(select(QuestionLog.quiz_id, QuestionLog.question_id)
+                                       .where(QuestionLog.quiz_id.in_(quiz_ids))).all())
+        for key in inserted.intersection(self.question_logs):
+            question_log = self.question_logs.pop(key)
+            self.question_details[key] = {column: question_log[column] for column in QUESTION_DETAIL_COLUMNS}
+
+    # writes the collected changes in the session's transaction; quiz logs are upserted and question logs inserted
+    # only once, so lines logged again (e.g. after a checkpoint reset) do not fail the chunk or duplicate rows
+    def write(self, session):
+        self.skip_inserted_question_logs(session)
+        bulk_upsert(session, QuizLog, list(self.quiz_logs.values()), ["quiz_start_time", "quiz_end_time"])
+        bulk_insert(session, QuestionLog, list(self.question_logs.values()))
+        bulk_update(session, QuizLog, [{"quiz_id": quiz_id, "quiz_end_time": quiz_end_time}
+                                       for quiz_id, quiz_end_time in self.quiz_end_times.items()], ["quiz_id"])
+        # all detail dicts contain the same columns (QUESTION_DETAIL_COLUMNS)
+        bulk_update(session, QuestionLog, [dict({"quiz_id": quiz_id, "question_id": question_id}, **details)
+                                           for (quiz_id, question_id), details in self.question_details.items()],
+                    ["quiz_id", "question_id"])
+
+
+# returns the logfiles with lines not inserted yet (or whose checkpoint must be reset), read without locking the
+# checkpoints, so the checkpoints of completely inserted logfiles are not locked by every chunk
+def get_pending_log_files(session, log_files: list):
+    checkpoints = {log_file: (inode, offset) for log_file, inode, offset
+                   in session.query(LogCheckpoint.log_file, LogCheckpoint.inode, LogCheckpoint.offset)
+                   .filter(LogCheckpoint.log_file.in_([str(log_file) for log_file in log_files]))}
+    pending_log_files = []
+    for log_file in log_files:
+        try:
+            stat = log_file.stat()
+        except FileNotFoundError:  # retired by another ingester
+            continue
+        if checkpoints.get(str(log_file)) != (stat.st_ino, stat.st_size):
+            pending_log_files.append(log_file)
+    return pending_log_files
+
+
+# returns the offset of the first line after the header of the logfile (0 if the header is not complete yet)
+def get_log_start_offset(log_file: Path):
+    with open(log_file, "rb") as binary_file:
+        first_line = binary_file.readline()
+    header = config.log_settings["csv_delimiter"].join(LOG_FILE_COLUMNS)
+    return len(first_line) if first_line.endswith(b"\n") and first_line.decode("utf-8").startswith(header) else 0
+
+
+# returns the offset after the last line of the logfile logged at or before LastLogDate: the logfile written before
+# there were shards was inserted up to this date without checkpoints, so these lines must not be inserted again
+def get_legacy_log_start_offset(session, log_file: Path):
+    offset = get_log_start_offset(log_file)
+    last_db_log_date = session.query(LastLogDate).first()
+    if last_db_log_date is None:
+        return offset
+    for _, _, line_offset, line in read_log_lines(0, log_file, offset):
+        if parse_log_time(line["log_time"]) <= last_db_log_date.date:
+            offset = line_offset
+    return offset
+
+
+# returns the checkpoint of the logfile, locked until the end of the transaction, and resets it if the logfile was
+# rotated (other inode) or truncated; the checkpoint of the logfile written before there were shards (legacy) starts
+# after the lines inserted before there were checkpoints
+def get_log_checkpoint(session, log_file: Path, legacy: bool = False):
+    stat = log_file.stat()
+    checkpoint = session.query(LogCheckpoint).filter(LogCheckpoint.log_file == str(log_file)).with_for_update().first()
+    if checkpoint is None:
+        offset = get_legacy_log_start_offset(session, log_file) if legacy else get_log_start_offset(log_file)
+        checkpoint = LogCheckpoint(log_file=str(log_file), inode=stat.st_ino, offset=offset)
+        session.add(checkpoint)
+    elif checkpoint.inode != stat.st_ino or checkpoint.offset > stat.st_size:
+        checkpoint.inode = stat.st_ino
+        checkpoint.offset = get_log_start_offset(log_file)
+    return checkpoint
+
+
+# inserts the next chunk of the merged logfile shards (of the given logfile) into the db in one transaction, returns
+# the number of inserted lines and the log time of the last one
+def ingest_log_chunk(log_file: Path, log_files: list):
+    with session_scope() as session:
+        log_files = get_pending_log_files(session, log_files)
+        checkpoints = [get_log_checkpoint(session, pending_log_file, legacy=pending_log_file == log_file)
+                       for pending_log_file in log_files]
+        watermark = time.time_ns() // 1000 - LOG_INGEST_GRACE_PERIOD * 1000000
+        chunk = LogChunk()
+        inserted_lines = 0
+        for seq, file_index, offset, line in heapq.merge(*[read_log_lines(file_index, log_file, checkpoint.offset)
+                                                           for file_index, (log_file, checkpoint)
+                                                           in enumerate(zip(log_files, checkpoints))]):
+            if seq > watermark or inserted_lines >= LOG_INGEST_CHUNK_LINES:
+                break
+            chunk.add_line(line)
+            checkpoints[file_index].offset = offset
+            inserted_lines += 1
+        chunk.write(session)
+        if chunk.last_log_time is not None:
+            # replace last db log (insertion) date
+            session.query(LastLogDate).delete()
+            session.add(LastLogDate(date=chunk.last_log_time))
+        return inserted_lines, chunk.last_log_time
+
+
+# deletes the closed shards whose lines have all been inserted, together with their checkpoints; returns the number
+# of retired shards
+def retire_log_shards(log_file: Path, log_files: list):
+    retired = 0
+    for shard in get_closed_log_shards(log_file, log_files):
+        with session_scope() as session:
+            checkpoint = session.query(LogCheckpoint).filter(LogCheckpoint.log_file == str(shard)) \
+                .with_for_update().first()
+            try:
+                stat = shard.stat()
+            except FileNotFoundError:  # retired by another ingester
+                if checkpoint is not None:
+                    session.delete(checkpoint)
                 continue
+            if checkpoint is None or checkpoint.inode != stat.st_ino or checkpoint.offset != stat.st_size:
+                continue  # lines not inserted yet
+            shard.unlink()
+            session.delete(checkpoint)
+            retired += 1
+    return retired
+
+
+# inserts new logs from the logfile shards into db and returns date of last log inserted
+def log_to_database(log_file: Path = None):
+    log_file = Path(log_file if log_file is not None else config.log_settings["ce_logfile"])
+    with log_ingest_lock:
+        log_files = get_log_files(log_file)
+        last_log_time = None
+        while True:
+            inserted_lines, chunk_log_time = ingest_log_chunk(log_file, log_files)
+            last_log_time = chunk_log_time if chunk_log_time is not None else last_log_time
+            if inserted_lines < LOG_INGEST_CHUNK_LINES:
+                break
+        retire_log_shards(log_file, log_files)
+    if last_log_time is None:  # no new logs
+        with session_scope() as session:
+            last_db_log_date = session.query(LastLogDate).first()
+            return last_db_log_date.date if last_db_log_date is not None else None
+    return last_log_time
+
 
-            ce_log = CELog(
-                log_time=file_log_date,
-                quiz_id=line["quiz_id"],
-                question_id=line["question_id"],
-                quiz_start_time=line["quiz_start_time"],
-                question_start_time=line["question_start_time"],
-                quiz_end_time=line["quiz_end_time"],
-                answer=line["answer"],
-                start_difficulty=line["start_difficulty"],
-                end_difficulty=line["end_difficulty"],
-                denominator=line["denominator"],
-                update_rate=line["update_rate"],
-                student_score=line["student_score"]
-            )
-
-            # (usual logging order: quiz_start_time > question_start_time > rest of question > quiz_end_time)
-
-            # check which "type" of logfile line it is
-            if ce_log.quiz_start_time != "None":  # if log with quiz_start_time is encountered
-                # insert new quiz log entry with only quiz_id and quiz_start_time (quiz_end_time is None/0)
-                session.add(QuizLog(
-                    quiz_id=ce_log.quiz_id,
-                    quiz_start_time=ce_log.quiz_start_time,
-                    quiz_end_time=ce_log.quiz_end_time
-                ))
-            elif ce_log.question_start_time != "None":  # if log with question_start_time is encountered
-                # insert new question log entry with only log_time, quiz_id, question_id
-                # and question_start_time (the rest is None/0)
-                session.add(QuestionLog(
-                    log_time=ce_log.log_time,
-                    quiz_id=ce_log.quiz_id,
-                    question_id=ce_log.question_id,
-                    question_start_time=ce_log.question_start_time,
-                    answer=ce_log.answer,
-                    start_difficulty=ce_log.start_difficulty,
-                    end_difficulty=ce_log.end_difficulty,
-                    denominator=ce_log.denominator,
-                    update_rate=ce_log.update_rate,
-                    student_score=ce_log.student_score
-                ))
-            elif ce_log.quiz_end_time != "None":  # if log with quiz_end_time is encountered
-                # update already existing quiz log with quiz end time
-                session.query(QuizLog) \
-                    .filter(QuizLog.quiz_id == ce_log.quiz_id) \
-                    .update({"quiz_end_time": ce_log.quiz_end_time}, synchronize_session="fetch")
-            else:  # any other log, these logs contain the rest of question log details
-                # update already existing question log with remaining question log details
-                session.query(QuestionLog) \
-                    .filter(QuestionLog.question_id == ce_log.question_id) \
-                    .update({
-                        "answer": ce_log.answer,
-                        "start_difficulty": ce_log.start_difficulty,
-                        "end_difficulty": ce_log.end_difficulty,
-                        "denominator": ce_log.denominator,
-                        "update_rate": ce_log.update_rate,
-                        "student_score": ce_log.student_score
-                    }, synchronize_session="fetch")
-                last_db_log_date = datetime.strptime(file_log_date, "%Y-%m-%d %H:%M:%S.%f")
-        # delete last db log (insertion) date
-        old_last_db_log_date = session.query(LastLogDate).first()
-        session.delete(old_last_db_log_date)
-        # add new db log (insertion) date
-        session.add(LastLogDate(date=last_db_log_date))
-        # commit all changes
-        session.commit()
-        return last_db_log_date
+# runs log_to_database every LOG_INGEST_INTERVAL seconds until it is stopped
+def run_log_ingester():
+    while True:
+        try:
+            log_to_database()
+        except Exception:
+            ingester_logger.exception("Log ingestion failed")
+        time.sleep(LOG_INGEST_INTERVAL)
@@ -0,0 +1,18 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# threads used for CPU-heavy work (estimation, selection) and blocking drivers, so the event loop stays free
+CPU_EXECUTOR_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_EXECUTOR_WORKERS, thread_name_prefix="cat-engine")
+
+
+# runs a blocking function in the CPU executor and waits for its result without blocking the event loop, the
+# function sees the context variables of the caller (like asyncio.to_thread)
+async def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(cpu_executor, functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,94 @@
+from contextlib import contextmanager
+
+from sqlalchemy import and_, bindparam, create_engine, insert, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import sessionmaker
+
+from src.cat.db_connector import engine
+
+# connection pool of the engine used by the CAT engine, per process
+DB_POOL_SIZE = 10  # connections kept open
+DB_MAX_OVERFLOW = 20  # additional connections opened under load
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+DB_POOL_RECYCLE = 30 * 60  # seconds after which a connection is replaced (below MySQL's wait_timeout)
+
+# dialect specific insert statements supporting upserts
+UPSERT_DIALECTS = {
+    "mysql": mysql,
+    "postgresql": postgresql,
+    "sqlite": sqlite,
+}
+
+
+# returns the pool settings for the backend (SQLite uses its own pool implementations)
+def get_pool_settings(backend: str):
+    if backend == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,  # replaces connections closed by the server before they are used
+    }
+
+
+# creates a pooled engine connecting to the same database as the engine of db_connector
+def create_pooled_engine():
+    return create_engine(engine.url, **get_pool_settings(engine.url.get_backend_name()))
+
+
+pooled_engine = create_pooled_engine()
+SessionLocal = sessionmaker(bind=pooled_engine)
+
+
+# provides a session whose changes are committed at the end of the block (rolled back on errors)
+@contextmanager
+def session_scope():
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# --------------- Bulk helpers ---------------
+
+# inserts the rows (dicts with column names) with one executemany statement
+def bulk_insert(session, model, rows: list):
+    if rows:
+        session.execute(insert(model.__table__), rows)
+
+
+# inserts the rows, rows whose primary key already exists update the update_columns instead
+def bulk_upsert(session, model, rows: list, update_columns: list):
+    if not rows:
+        return
+    table = model.__table__
+    backend = session.get_bind().dialect.name
+    statement = UPSERT_DIALECTS[backend].insert(table)
+    if backend == "mysql":
+        statement = statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key.columns],
+            set_={column: statement.excluded[column] for column in update_columns})
+    session.execute(statement, rows)
+
+
+# updates the rows matching the key_columns of each row with its other values, with one executemany statement;
+# all rows must contain the same columns
+def bulk_update(session, model, rows: list, key_columns: list):
+    if not rows:
+        return
+    table = model.__table__
+    value_columns = [column for column in rows[0] if column not in key_columns]
+    session.execute(
+        update(table)
+        .where(and_(*[table.c[column] == bindparam("b_" + column) for column in key_columns]))
+        .values({column: bindparam("b_" + column) for column in value_columns}),
+        [{"b_" + column: value for column, value in row.items()} for row in rows])
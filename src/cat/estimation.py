@@ -0,0 +1,103 @@
+import numpy as np
+from catsim.simulation import Estimator
+
+# number of points of the theta grid used to find the starting point of the Newton-Raphson iterations
+QUADRATURE_POINTS = 81
+
+# Newton-Raphson iterations stop when a step is smaller than the tolerance or after max_iterations
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 20
+
+# probabilities are clipped to [EPSILON, 1 - EPSILON] before taking logarithms
+EPSILON = 1e-12
+
+
+class NewtonRaphsonEstimator(Estimator):
+    """Maximum likelihood estimator using Newton-Raphson (Fisher scoring) steps, vectorized with NumPy.
+
+    The starting point is the best of the previous estimate (warm start) and the maximum of the log-likelihood on a
+    precomputed grid, so the global maximum is found like with
+    :py:class:`catsim.estimation.DifferentialEvolutionEstimator`, at a fraction of the cost.
+
+    :param bounds: a tuple containing the smallest and largest difficulty of the item bank. Like the
+                   DifferentialEvolutionEstimator, the estimate is searched between twice these values.
+    """
+
+    def __str__(self):
+        return 'Newton-Raphson Estimator'
+
+    def __init__(self, bounds: tuple, quadrature_points: int = QUADRATURE_POINTS, tolerance: float = TOLERANCE,
+                 max_iterations: int = MAX_ITERATIONS):
+        super().__init__()
+        self._lower_bound = min(bounds) * 2
+        self._upper_bound = max(bounds) * 2
+        self._grid = np.linspace(self._lower_bound, self._upper_bound, quadrature_points)
+        self._tolerance = tolerance
+        self._max_iterations = max_iterations
+
+    def estimate(self, index: int = None, items: np.ndarray = None, administered_items: list = None,
+                 response_vector: list = None, est_theta: float = None, **kwargs) -> float:
+        """Returns the theta value that maximizes the log-likelihood of the response vector.
+
+        :param index: index of the current examinee in the simulator
+        :param items: a matrix containing item parameters in the format that `catsim` understands
+        :param administered_items: a list containing the indexes of items that were already administered
+        :param response_vector: a boolean list containing the examinee's answers to the administered items
+        :param est_theta: the previous estimate, used as warm start
+        :returns: the current :math:`\\hat\\theta`
+        """
+        if (index is None or self.simulator is None) and (items is None or response_vector is None):
+            raise ValueError(
+                'Either pass an index for the simulator or all of the other optional parameters to use this '
+                'component independently.')
+
+        if items is None and administered_items is None and response_vector is None:
+            items = self.simulator.items
+            administered_items = self.simulator.administered_items[index]
+            response_vector = self.simulator.response_vectors[index]
+            est_theta = self.simulator.latest_estimations[index]
+
+        administered = items[administered_items]
+        responses = np.asarray(response_vector, dtype=bool)
+
+        # starting point: grid maximum, replaced by the previous estimate if that is at least as likely
+        grid_log_likelihoods = log_likelihoods(self._grid, administered, responses)
+        theta = self._grid[np.argmax(grid_log_likelihoods)]
+        if est_theta is not None and self._lower_bound <= est_theta <= self._upper_bound:
+            if log_likelihoods(np.array([est_theta]), administered, responses)[0] >= grid_log_likelihoods.max():
+                theta = est_theta
+
+        for _ in range(self._max_iterations):
+            score, information = score_and_information(theta, administered, responses)
+            if information <= 0:
+                break
+            new_theta = min(max(theta + score / information, self._lower_bound), self._upper_bound)
+            step = abs(new_theta - theta)
+            theta = new_theta
+            if step < self._tolerance:
+                break
+
+        return float(theta)
+
+
+# returns the probabilities of correct answers, one row per theta and one column per item
+def probabilities(thetas: np.ndarray, items: np.ndarray):
+    a, b, c, d = items[:, 0], items[:, 1], items[:, 2], items[:, 3]
+    return c + (d - c) / (1 + np.exp(-a * (thetas[:, None] - b)))
+
+
+# returns the log-likelihood of the responses for every theta
+def log_likelihoods(thetas: np.ndarray, items: np.ndarray, responses: np.ndarray):
+    p = np.clip(probabilities(thetas, items), EPSILON, 1 - EPSILON)
+    return np.where(responses, np.log(p), np.log1p(-p)).sum(axis=1)
+
+
+# returns the first derivative of the log-likelihood and the test information at theta
+def score_and_information(theta: float, items: np.ndarray, responses: np.ndarray):
+    a, c, d = items[:, 0], items[:, 2], items[:, 3]
+    p = np.clip(probabilities(np.array([theta]), items)[0], EPSILON, 1 - EPSILON)
+    p_q = p * (1 - p)
+    slope = a * (p - c) * (d - p) / (d - c)  # derivative of p with respect to theta
+    score = np.sum(slope * (responses - p) / p_q)
+    information = np.sum(slope ** 2 / p_q)
+    return score, information
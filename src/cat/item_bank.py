@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from src.cat.async_db_connector import ar
+from src.cat.db_connector import r
+from src.cat.metrics import StageSpan
+from src.models.fastapi_models import QuestionAPI
+
+# number of decoded item banks kept in memory per process
+ITEM_BANK_CACHE_SIZE = 256
+
+# seconds a published item bank version stays current before the questions of the topic are fetched again
+TOPIC_BANK_TTL = 15 * 60
+
+# seconds an item bank version is kept after it was published; every save of a quiz using it restarts its expiry
+# with the expiry of the quiz (see QuizState.queue_save), so it outlives the quizzes referencing it
+ITEM_BANK_TTL = 24 * 60 * 60
+
+# seconds a process waits for another process fetching the questions of the same topic, and its polling interval
+TOPIC_BANK_FETCH_TIMEOUT = 30
+TOPIC_BANK_FETCH_POLL_INTERVAL = 0.05
+
+# item matrices are stored as packed little-endian float64 rows (discrimination, difficulty, pseudoGuessing,
+# upperAsymptote), so they can be decoded without parsing
+ITEM_DTYPE = np.dtype('<f8')
+ITEM_COLUMNS = 4
+
+
+# class holding the item bank of a topic: the catsim item matrix and the question/material ids sharing its row index
+class ItemBank:
+    def __init__(self, items: np.ndarray, question_ids: list, material_ids: list):
+        self.items = items
+        self.question_ids = question_ids
+        self.material_ids = material_ids
+        self.selection_indexes = {}  # item orderings used for the next item selection, see src.cat.selection
+
+    # creates the item bank from difficulties only (any sequence or buffer of floats), the other parameters get
+    # the QuestionAPI defaults
+    @classmethod
+    def from_difficulties(cls, difficulties, question_ids: list, material_ids: list):
+        items = np.empty([len(question_ids), ITEM_COLUMNS], dtype=ITEM_DTYPE)
+        items[:, 0] = 1.0  # discrimination
+        items[:, 1] = difficulties
+        items[:, 2] = 0.0  # pseudoGuessing
+        items[:, 3] = 1.0  # upperAsymptote
+        return cls(items, question_ids, material_ids)
+
+    def __len__(self):
+        return self.items.shape[0]
+
+    # returns the item with the given index as QuestionAPI object
+    def get_question(self, item_index: int):
+        item = self.items[item_index]
+        return QuestionAPI(id=self.question_ids[item_index],
+                           materialId=self.material_ids[item_index],
+                           discrimination=item[0],
+                           difficulty=item[1], pseudoGuessing=item[2], upperAsymptote=item[3])
+
+    # returns all items as QuestionAPI objects
+    def get_questions(self):
+        return [self.get_question(item_index) for item_index in range(len(self))]
+
+
+# bounded least-recently-used cache
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+item_bank_cache = LRUCache(ITEM_BANK_CACHE_SIZE)  # (topic_id, bank_version) -> ItemBank
+
+
+# --------------- Encoding ---------------
+
+# packs an item bank into the item matrix blob and the id table
+def pack_item_bank(bank: ItemBank):
+    id_table = json.dumps({"questionIds": bank.question_ids,
+                           "materialIds": bank.material_ids})
+    return np.ascontiguousarray(bank.items, dtype=ITEM_DTYPE).tobytes(), id_table
+
+
+# returns the content hash of a packed item bank
+def hash_item_bank(items_blob: bytes, id_table: str):
+    content_hash = hashlib.sha256(items_blob)
+    content_hash.update(id_table.encode())
+    return content_hash.hexdigest()
+
+
+# decodes the item matrix blob (zero-copy) and the id table into an ItemBank
+def unpack_item_bank(items_blob: bytes, id_table: bytes):
+    items = np.frombuffer(items_blob, dtype=ITEM_DTYPE).reshape(-1, ITEM_COLUMNS)
+    ids = json.loads(id_table)
+    return ItemBank(items, ids["questionIds"], ids["materialIds"])
+
+
+# --------------- Storage ---------------
+
+# Item banks are stored once per topic and version. A quiz only references (topicId, bankVersion). The current
+# version of a topic expires after TOPIC_BANK_TTL, then the next quiz creation fetches the
+# questions again and publishes a new version, unless they are unchanged: then the last published version is made
+# the current one again and its expiry restarted. Concurrent creations for the same topic share one fetch. A version
+# expires ITEM_BANK_TTL after it was published or last used by a quiz.
+
+def get_r_bank_prefix(topic_id: str, bank_version: int):
+    return "topicBank_" + str(topic_id) + "_" + str(bank_version) + "_"
+
+
+def get_r_version_key(topic_id: str):  # current item bank version of the topic
+    return "topicBank_" + str(topic_id) + "_version"
+
+
+def get_r_version_counter_key(topic_id: str):  # last item bank version ever published for the topic
+    return "topicBank_" + str(topic_id) + "_versionCounter"
+
+
+def get_r_published_key(topic_id: str):  # version and content hash of the last item bank published for the topic
+    return "topicBank_" + str(topic_id) + "_published"
+
+
+def get_r_fetch_lock_key(topic_id: str):  # held by the process fetching the questions of the topic
+    return "topicBank_" + str(topic_id) + "_fetchLock"
+
+
+# returns the current item bank version of a topic or None if there is no current item bank
+def get_topic_bank_version(topic_id: str):
+    return parse_bank_version(r.get(get_r_version_key(topic_id)))
+
+
+async def get_topic_bank_version_async(topic_id: str):
+    return parse_bank_version(await ar.get(get_r_version_key(topic_id)))
+
+
+def parse_bank_version(bank_version: bytes):
+    return int(bank_version) if bank_version is not None else None
+
+
+# returns the last published item bank version of a topic if its content hash is the given one, otherwise None
+def get_unchanged_bank_version(topic_id: str, item_hash: str):
+    return parse_unchanged_bank_version(r.hmget(get_r_published_key(topic_id), "version", "itemHash"), item_hash)
+
+
+async def get_unchanged_bank_version_async(topic_id: str, item_hash: str):
+    return parse_unchanged_bank_version(await ar.hmget(get_r_published_key(topic_id), "version", "itemHash"),
+                                        item_hash)
+
+
+def parse_unchanged_bank_version(published: list, item_hash: str):
+    bank_version, published_hash = published
+    if published_hash is None or published_hash.decode() != item_hash:
+        return None
+    return parse_bank_version(bank_version)
+
+
+# adds the commands storing an item bank version to the given pipeline
+def queue_store(pipe, topic_id: str, bank_version: int, items_blob: bytes, id_table: str):
+    pipe.set(get_r_bank_prefix(topic_id, bank_version) + "itemMatrix", items_blob, ex=ITEM_BANK_TTL)
+    pipe.set(get_r_bank_prefix(topic_id, bank_version) + "itemIds", id_table, ex=ITEM_BANK_TTL)
+
+
+# adds the commands storing a new item bank version and making it the current one to the given pipeline
+def queue_publish(pipe, topic_id: str, bank_version: int, items_blob: bytes, id_table: str, item_hash: str):
+    queue_store(pipe, topic_id, bank_version, items_blob, id_table)
+    pipe.hset(get_r_published_key(topic_id), mapping={"version": bank_version, "itemHash": item_hash})
+    pipe.expire(get_r_published_key(topic_id), ITEM_BANK_TTL)
+    pipe.set(get_r_version_key(topic_id), bank_version, ex=TOPIC_BANK_TTL)
+
+
+# adds the commands making a stored item bank version the current one again to the given pipeline
+def queue_republish(pipe, topic_id: str, bank_version: int):
+    pipe.expire(get_r_published_key(topic_id), ITEM_BANK_TTL)
+    pipe.set(get_r_version_key(topic_id), bank_version, ex=TOPIC_BANK_TTL)
+
+
+# adds the commands restarting the expiry of an item bank version to the given pipeline
+def queue_expire_item_bank(pipe, topic_id: str, bank_version: int, ttl: int):
+    pipe.expire(get_r_bank_prefix(topic_id, bank_version) + "itemMatrix", ttl)
+    pipe.expire(get_r_bank_prefix(topic_id, bank_version) + "itemIds", ttl)
+
+
+# stores the item bank of a topic as new version and returns the version number; if it equals the last published
+# version (which has not expired yet), that version is made the current one again instead
+def publish_topic_bank(topic_id: str, bank: ItemBank):
+    items_blob, id_table = pack_item_bank(bank)
+    item_hash = hash_item_bank(items_blob, id_table)
+    bank_version = get_unchanged_bank_version(topic_id, item_hash)
+    if bank_version is not None:
+        pipe = r.pipeline(transaction=True)
+        queue_expire_item_bank(pipe, topic_id, bank_version, ITEM_BANK_TTL)
+        if all(pipe.execute()):  # both keys of the version still exist
+            pipe = r.pipeline(transaction=True)
+            queue_republish(pipe, topic_id, bank_version)
+            pipe.execute()
+            return bank_version
+    bank_version = r.incr(get_r_version_counter_key(topic_id))
+    pipe = r.pipeline(transaction=True)
+    queue_publish(pipe, topic_id, bank_version, items_blob, id_table, item_hash)
+    pipe.execute()
+    return bank_version
+
+
+# stores the item bank of a topic as new version without making it the current one (e.g. the questions of a quiz
+# created before item banks were shared) and returns the version number
+def store_topic_bank(topic_id: str, bank: ItemBank):
+    items_blob, id_table = pack_item_bank(bank)
+    bank_version = r.incr(get_r_version_counter_key(topic_id))
+    pipe = r.pipeline(transaction=True)
+    queue_store(pipe, topic_id, bank_version, items_blob, id_table)
+    pipe.execute()
+    return bank_version
+
+
+async def publish_topic_bank_async(topic_id: str, bank: ItemBank):
+    items_blob, id_table = pack_item_bank(bank)
+    item_hash = hash_item_bank(items_blob, id_table)
+    bank_version = await get_unchanged_bank_version_async(topic_id, item_hash)
+    if bank_version is not None:
+        pipe = ar.pipeline(transaction=True)
+        queue_expire_item_bank(pipe, topic_id, bank_version, ITEM_BANK_TTL)
+        if all(await pipe.execute()):  # both keys of the version still exist
+            pipe = ar.pipeline(transaction=True)
+            queue_republish(pipe, topic_id, bank_version)
+            await pipe.execute()
+            return bank_version
+    bank_version = await ar.incr(get_r_version_counter_key(topic_id))
+    pipe = ar.pipeline(transaction=True)
+    queue_publish(pipe, topic_id, bank_version, items_blob, id_table, item_hash)
+    await pipe.execute()
+    return bank_version
+
+
+# --------------- Fetch coalescing ---------------
+
+fetch_locks = {}  # topic_id -> threading.Lock, one fetch per topic and process (blocking callers)
+fetch_locks_lock = threading.Lock()
+pending_fetches = {}  # topic_id -> asyncio.Task, one fetch per topic and process (async callers)
+
+
+# returns the current item bank version of a topic; if there is none, the item bank is fetched with
+# fetch_item_bank(topic_id) and published as new version
+def get_current_topic_bank_version(topic_id: str, fetch_item_bank):
+    bank_version = get_topic_bank_version(topic_id)
+    if bank_version is not None:
+        return bank_version
+    with fetch_locks_lock:
+        fetch_lock = fetch_locks.setdefault(topic_id, threading.Lock())
+    with fetch_lock:
+        bank_version = get_topic_bank_version(topic_id)  # published while waiting for the lock
+        if bank_version is None:
+            bank_version = fetch_and_publish_topic_bank(topic_id, fetch_item_bank)
+    return bank_version
+
+
+# fetches and publishes the item bank of a topic, unless another process is already doing so
+def fetch_and_publish_topic_bank(topic_id: str, fetch_item_bank):
+    deadline = time.monotonic() + TOPIC_BANK_FETCH_TIMEOUT
+    locked = r.set(get_r_fetch_lock_key(topic_id), 1, nx=True, ex=TOPIC_BANK_FETCH_TIMEOUT)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(TOPIC_BANK_FETCH_POLL_INTERVAL)
+        bank_version = get_topic_bank_version(topic_id)
+        if bank_version is not None:  # published by the other process
+            return bank_version
+        locked = r.set(get_r_fetch_lock_key(topic_id), 1, nx=True, ex=TOPIC_BANK_FETCH_TIMEOUT)
+    try:
+        return publish_topic_bank(topic_id, fetch_item_bank(topic_id))
+    finally:
+        if locked:
+            r.delete(get_r_fetch_lock_key(topic_id))
+
+
+# same as get_current_topic_bank_version, fetch_item_bank is a coroutine function
+async def get_current_topic_bank_version_async(topic_id: str, fetch_item_bank):
+    bank_version = await get_topic_bank_version_async(topic_id)
+    if bank_version is not None:
+        return bank_version
+    pending_fetch = pending_fetches.get(topic_id)
+    if pending_fetch is None:
+        pending_fetch = asyncio.ensure_future(fetch_and_publish_topic_bank_async(topic_id, fetch_item_bank))
+        pending_fetches[topic_id] = pending_fetch
+        pending_fetch.add_done_callback(lambda _: pending_fetches.pop(topic_id, None))
+    return await asyncio.shield(pending_fetch)
+
+
+async def fetch_and_publish_topic_bank_async(topic_id: str, fetch_item_bank):
+    deadline = time.monotonic() + TOPIC_BANK_FETCH_TIMEOUT
+    locked = await ar.set(get_r_fetch_lock_key(topic_id), 1, nx=True, ex=TOPIC_BANK_FETCH_TIMEOUT)
+    while not locked and time.monotonic() < deadline:
+        await asyncio.sleep(TOPIC_BANK_FETCH_POLL_INTERVAL)
+        bank_version = await get_topic_bank_version_async(topic_id)
+        if bank_version is not None:  # published by the other process
+            return bank_version
+        locked = await ar.set(get_r_fetch_lock_key(topic_id), 1, nx=True, ex=TOPIC_BANK_FETCH_TIMEOUT)
+    try:
+        return await publish_topic_bank_async(topic_id, await fetch_item_bank(topic_id))
+    finally:
+        if locked:
+            await ar.delete(get_r_fetch_lock_key(topic_id))
+
+
+# --------------- Loading ---------------
+
+# returns the item bank of a topic version, decoding it from Redis only if it is not cached yet
+def get_item_bank(topic_id: str, bank_version: int):
+    bank = item_bank_cache.get((topic_id, bank_version))
+    if bank is None:
+        items_blob, id_table = r.mget(get_r_bank_prefix(topic_id, bank_version) + "itemMatrix",
+                                      get_r_bank_prefix(topic_id, bank_version) + "itemIds")
+        with StageSpan("itemBankDecode"):
+            bank = unpack_item_bank(items_blob, id_table)
+        item_bank_cache.put((topic_id, bank_version), bank)
+    return bank
+
+
+async def get_item_bank_async(topic_id: str, bank_version: int):
+    bank = item_bank_cache.get((topic_id, bank_version))
+    if bank is None:
+        items_blob, id_table = await ar.mget(get_r_bank_prefix(topic_id, bank_version) + "itemMatrix",
+                                             get_r_bank_prefix(topic_id, bank_version) + "itemIds")
+        with StageSpan("itemBankDecode"):
+            bank = unpack_item_bank(items_blob, id_table)
+        item_bank_cache.put((topic_id, bank_version), bank)
+    return bank
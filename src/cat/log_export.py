@@ -0,0 +1,155 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import func, not_, or_, select
+
+from src.cat.db_session import session_scope
+from src.cat.quiz_state import QUIZ_TTL
+from src.models.sqlalchemy_models import Difficulty, QuestionLog, QuizLog
+
+# Exports the QuestionLogs to Parquet files for item analyses, partitioned by date (of log_time) and topic:
+#   <output_dir>/date=2023-05-01/topic_id=equations/part-<run>-<n>.parquet
+# A question belonging to several topics is exported to the partition of each of its topics. Each run only exports
+# the logs added since the last run (the last exported log_id is stored in <output_dir>/_export_checkpoint.json),
+# up to the last log_id when the run started. Only complete logs are exported: answered, of a finished quiz or older
+# than the quizzes live (QUIZ_TTL); the export stops before the first incomplete log, it is exported by a later run
+# once it is complete. The logs of the calibration (without quiz_id) are not exported.
+# pyarrow is an optional dependency, only needed for the export: pip install pyarrow
+
+# number of rows fetched from the db and written per batch
+EXPORT_BATCH_ROWS = 100000
+
+EXPORT_CHECKPOINT_FILE = "_export_checkpoint.json"
+
+EXPORT_COLUMNS = [
+    QuestionLog.log_id, QuestionLog.log_time, QuestionLog.quiz_id, QuestionLog.question_id,
+    QuestionLog.question_start_time, QuestionLog.answer, QuestionLog.start_difficulty, QuestionLog.end_difficulty,
+    QuestionLog.denominator, QuestionLog.update_rate, QuestionLog.student_score, Difficulty.topic_id,
+]
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+    except ImportError as error:
+        raise ImportError("The log export needs pyarrow, install it with: pip install pyarrow") from error
+    return pyarrow
+
+
+# returns the schema of the exported logs (the partition columns date and topic_id are added when writing)
+def get_export_schema():
+    pa = import_pyarrow()
+    return pa.schema([
+        ("log_id", pa.int64()),
+        ("log_time", pa.timestamp("ms")),
+        ("quiz_id", pa.int64()),
+        ("question_id", pa.int32()),
+        ("question_start_time", pa.timestamp("ms")),
+        ("answer", pa.int8()),
+        ("start_difficulty", pa.float64()),
+        ("end_difficulty", pa.float64()),
+        ("denominator", pa.float64()),
+        ("update_rate", pa.float64()),
+        ("student_score", pa.float64()),
+        ("topic_id", pa.string()),
+    ])
+
+
+def get_export_partitioning():
+    pa = import_pyarrow()
+    return pa.dataset.partitioning(pa.schema([("date", pa.date32()), ("topic_id", pa.string())]), flavor="hive")
+
+
+def read_export_checkpoint(output_dir: Path):
+    checkpoint_file = output_dir / EXPORT_CHECKPOINT_FILE
+    if not checkpoint_file.is_file():
+        return 0
+    return json.loads(checkpoint_file.read_text())["lastLogId"]
+
+
+def write_export_checkpoint(output_dir: Path, last_log_id: int):
+    checkpoint_file = output_dir / EXPORT_CHECKPOINT_FILE
+    temporary_file = checkpoint_file.with_suffix(".tmp")
+    temporary_file.write_text(json.dumps({"lastLogId": last_log_id}))
+    temporary_file.replace(checkpoint_file)
+
+
+# converts a batch of db rows into an arrow table with the export schema and the date partition column
+def rows_to_table(rows: list):
+    pa = import_pyarrow()
+    schema = get_export_schema()
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_floating(field.type):  # DECIMAL columns are returned as Decimal
+            values = [float(value) if value is not None else None for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    table = pa.Table.from_arrays(arrays, schema=schema)
+    return table.append_column("date", pa.compute.cast(table["log_time"], pa.date32()))
+
+
+# returns the last log_id the export of this run may reach: the last log_id when the run started, or the one before
+# the first incomplete log of a quiz (None if there are no new logs)
+def get_export_end_log_id(session, last_log_id: int):
+    end_log_id = session.execute(select(func.max(QuestionLog.log_id))
+                                 .where(QuestionLog.log_id > last_log_id)).scalar()
+    if end_log_id is None:
+        return None
+    complete = or_(QuestionLog.answer.isnot(None),
+                   QuizLog.quiz_end_time.isnot(None),
+                   QuestionLog.log_time < datetime.now() - timedelta(seconds=QUIZ_TTL))  # the quiz has expired
+    first_incomplete_log_id = session.execute(
+        select(func.min(QuestionLog.log_id))
+        .outerjoin(QuizLog, QuizLog.quiz_id == QuestionLog.quiz_id)
+        .where(QuestionLog.log_id > last_log_id, QuestionLog.log_id <= end_log_id,
+               QuestionLog.quiz_id.isnot(None), not_(complete))).scalar()
+    return first_incomplete_log_id - 1 if first_incomplete_log_id is not None else end_log_id
+
+
+# exports the complete QuestionLogs added since the last export, returns the number of exported rows
+def export_question_logs(output_dir):
+    pa = import_pyarrow()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    last_log_id = read_export_checkpoint(output_dir)
+    run_id = uuid.uuid4().hex[:12]
+    partitioning = get_export_partitioning()
+    exported_rows = 0
+    with session_scope() as session:
+        end_log_id = get_export_end_log_id(session, last_log_id)
+        if end_log_id is None or end_log_id <= last_log_id:
+            return exported_rows
+        result = session.execute(
+            select(*EXPORT_COLUMNS)
+            .outerjoin(Difficulty, Difficulty.question_id == QuestionLog.question_id)
+            .where(QuestionLog.log_id > last_log_id, QuestionLog.log_id <= end_log_id,
+                   QuestionLog.quiz_id.isnot(None))
+            .order_by(QuestionLog.log_id),
+            execution_options={"stream_results": True})
+        for batch_index, rows in enumerate(result.partitions(EXPORT_BATCH_ROWS)):
+            pa.dataset.write_dataset(rows_to_table(rows), output_dir, format="parquet", partitioning=partitioning,
+                                     basename_template=f"part-{run_id}-{batch_index}-{{i}}.parquet",
+                                     existing_data_behavior="overwrite_or_ignore")
+            exported_rows += len(rows)
+            last_log_id = rows[-1].log_id
+            write_export_checkpoint(output_dir, last_log_id)
+    write_export_checkpoint(output_dir, end_log_id)  # also skips the calibration logs at the end
+    return exported_rows
+
+
+# reads the exported logs as arrow table, optionally only some columns, topics or dates (datetime.date objects);
+# only the matching partitions are read, use .to_pandas() on the result for a DataFrame
+def read_question_logs(output_dir, columns: list = None, topics: list = None, start_date=None, end_date=None):
+    pa = import_pyarrow()
+    dataset = pa.dataset.dataset(Path(output_dir), format="parquet", partitioning=get_export_partitioning())
+    condition = None
+    for expression in [pa.dataset.field("topic_id").isin(topics) if topics is not None else None,
+                       pa.dataset.field("date") >= start_date if start_date is not None else None,
+                       pa.dataset.field("date") <= end_date if end_date is not None else None]:
+        if expression is not None:
+            condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=columns, filter=condition)
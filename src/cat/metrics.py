@@ -0,0 +1,275 @@
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from redis.exceptions import RedisError
+
+from src.cat.async_db_connector import ar
+
+# Metrics of the CAT engine in the Prometheus text format, served by GET /metrics. Observations are added to the
+# histograms and counters of the process in memory (a bisect and two additions); every METRICS_FLUSH_INTERVAL
+# seconds and before a scrape, each process adds them to the totals of all processes in Redis (one hash per metric),
+# so a scrape of any worker returns the metrics of all workers. The counters of the calibration worker are written
+# to Redis directly by the worker.
+
+# upper bounds of the histogram buckets in seconds
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# seconds between two flushes of the metrics of a process to Redis (observations since the last flush are lost if
+# the process is killed)
+METRICS_FLUSH_INTERVAL = 5
+
+# counters written by the calibration worker
+METRICS_QUIZZES_CALIBRATED_KEY = "metricsQuizzesCalibrated"
+METRICS_CALIBRATION_FLUSHES_KEY = "metricsCalibrationFlushes"
+METRICS_CALIBRATION_FLUSH_SECONDS_KEY = "metricsCalibrationFlushSeconds"
+
+
+metrics_logger = logging.getLogger(__name__)
+
+
+def get_r_metric_key(name: str):  # hash with the totals of a metric of all processes
+    return "metrics_" + name
+
+
+# the fields of the metric hashes are the label values (and the bucket of a histogram) as JSON list
+def encode_metric_field(values: tuple):
+    return json.dumps(list(values))
+
+
+def decode_metric_field(field: bytes):
+    return tuple(json.loads(field))
+
+
+def format_labels(label_names: tuple, label_values: tuple):
+    if not label_names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, label_values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.key = get_r_metric_key(name)
+        self.values = {}  # label values -> count since the last flush
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    # returns the counts since the last flush and starts counting from 0
+    def take_pending(self):
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    # adds counts taken by take_pending back, e.g. if they could not be flushed
+    def restore_pending(self, values: dict):
+        for label_values, value in values.items():
+            self.inc(*label_values, amount=value)
+
+    def queue_flush(self, pipe, values: dict):
+        for label_values, value in values.items():
+            pipe.hincrbyfloat(self.key, encode_metric_field(label_values), value)
+
+    # renders the totals of all processes (the hash of the metric)
+    def render(self, totals: dict):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        values = {decode_metric_field(field): float(value) for field, value in totals.items()}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.key = get_r_metric_key(name)
+        # label values -> [counts per bucket (the last one is +Inf), sum] since the last flush
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    # returns the series since the last flush and starts again with empty series
+    def take_pending(self):
+        with self._lock:
+            series, self.series = self.series, {}
+        return series
+
+    # adds series taken by take_pending back, e.g. if they could not be flushed
+    def restore_pending(self, series: dict):
+        with self._lock:
+            for label_values, (counts, total) in series.items():
+                current = self.series.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0])
+                current[0] = [current_count + count for current_count, count in zip(current[0], counts)]
+                current[1] += total
+
+    # the fields are the label values with the bucket index or "sum" appended
+    def queue_flush(self, pipe, series: dict):
+        for label_values, (counts, total) in series.items():
+            for bucket, count in enumerate(counts):
+                if count:
+                    pipe.hincrby(self.key, encode_metric_field(label_values + (bucket,)), count)
+            pipe.hincrbyfloat(self.key, encode_metric_field(label_values + ("sum",)), total)
+
+    # renders the totals of all processes (the hash of the metric)
+    def render(self, totals: dict):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        series = {}  # label values -> [counts per bucket, sum]
+        for field, value in totals.items():
+            *label_values, bucket = decode_metric_field(field)
+            label_series = series.setdefault(tuple(label_values), [[0] * (len(self.buckets) + 1), 0.0])
+            if bucket == "sum":
+                label_series[1] = float(value)
+            else:
+                label_series[0][bucket] = int(value)
+        for label_values, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.label_names + ("le",), label_values + (upper_bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_DURATION = Histogram("cat_stage_duration_seconds", "Duration of the stages of the CAT engine", ("stage",))
+REQUEST_DURATION = Histogram("cat_request_duration_seconds", "Duration of the REST calls", ("method", "route"))
+QUIZZES_CREATED = Counter("cat_quizzes_created_total", "Quizzes created")
+QUIZZES_FINISHED = Counter("cat_quizzes_finished_total", "Quizzes finished")
+
+METRICS = [STAGE_DURATION, REQUEST_DURATION, QUIZZES_CREATED, QUIZZES_FINISHED]
+
+
+# context manager timing a stage of the engine: with StageSpan("estimate"): ...
+class StageSpan:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_DURATION.observe(time.perf_counter() - self.start, self.stage)
+        return False
+
+
+# decorator timing every call of a function (or coroutine function) as stage
+def timed_stage(stage: str):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                with StageSpan(stage):
+                    return await func(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with StageSpan(stage):
+                return func(*args, **kwargs)
+        return timed
+    return decorator
+
+
+# ASGI middleware recording the duration of the REST calls per route (plain ASGI, so it adds no extra task per call)
+class RequestDurationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")  # set by the router, the path template keeps the number of series small
+            if route is not None:
+                REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"], route.path)
+
+
+# adds the counters of a calibration flush to the given pipeline (called by the calibration worker)
+def queue_calibration_metrics(pipe, calibrated_quizzes: int, flush_seconds: float):
+    pipe.incrby(METRICS_QUIZZES_CALIBRATED_KEY, calibrated_quizzes)
+    pipe.incr(METRICS_CALIBRATION_FLUSHES_KEY)
+    pipe.incrbyfloat(METRICS_CALIBRATION_FLUSH_SECONDS_KEY, flush_seconds)
+
+
+# returns the metrics of the calibration worker from the values of the calibration counter keys and the length of
+# the calibration stream
+def render_calibration_metrics(quizzes_calibrated: bytes, flushes: bytes, flush_seconds: bytes, pending_jobs: int):
+    return [
+        "# HELP cat_quizzes_calibrated_total Quizzes calibrated by all calibration workers",
+        "# TYPE cat_quizzes_calibrated_total counter",
+        f"cat_quizzes_calibrated_total {int(quizzes_calibrated or 0)}",
+        "# HELP cat_calibration_flush_duration_seconds Duration of the calibration flushes of all workers",
+        "# TYPE cat_calibration_flush_duration_seconds summary",
+        f"cat_calibration_flush_duration_seconds_sum {float(flush_seconds or 0)}",
+        f"cat_calibration_flush_duration_seconds_count {int(flushes or 0)}",
+        "# HELP cat_calibration_jobs_queued Calibration jobs in the calibration stream",
+        "# TYPE cat_calibration_jobs_queued gauge",
+        f"cat_calibration_jobs_queued {pending_jobs}",
+    ]
+
+
+# adds the observations of this process since the last flush to the totals in Redis
+async def flush_metrics_async():
+    pending = [(metric, metric.take_pending()) for metric in METRICS]
+    pipe = ar.pipeline(transaction=True)
+    for metric, values in pending:
+        metric.queue_flush(pipe, values)
+    try:
+        await pipe.execute()
+    except BaseException:
+        for metric, values in pending:
+            metric.restore_pending(values)
+        raise
+
+
+# flushes the metrics of this process every METRICS_FLUSH_INTERVAL seconds until it is cancelled
+async def run_metrics_flusher():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await flush_metrics_async()
+        except RedisError:
+            metrics_logger.exception("Metrics flush failed")
+
+
+# adds the commands reading the totals of the metrics to the given pipeline, pass their results to render_metrics
+def queue_load_metrics(pipe):
+    for metric in METRICS:
+        pipe.hgetall(metric.key)
+
+
+def render_metrics(totals: list, extra_lines: list = None):
+    lines = []
+    for metric, metric_totals in zip(METRICS, totals):
+        lines.extend(metric.render(metric_totals))
+    lines.extend(extra_lines or [])
+    return "\n".join(lines) + "\n"
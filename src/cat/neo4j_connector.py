@@ -0,0 +1,49 @@
+import threading
+import urllib
+
+from neo4j import GraphDatabase
+
+neo4j = {
+    "user": 'neo4j',
+    "password": urllib.parse.quote('jdUUxfTkvPyb2LZ_i-mQ5eiYOwgc1BcHfjJA0hcmQzQ'),
+    "host": 'neo4j+s://feb9a4ae.databases.neo4j.io:7687',
+}
+
+# connections kept open by the driver, shared by all requests of the process
+NEO4J_MAX_CONNECTION_POOL_SIZE = 50
+
+# number of records fetched from the server per batch when streaming query results
+NEO4J_FETCH_SIZE = 5000
+
+# indexes the queries of the CAT engine rely on
+NEO4J_INDEXES = [
+    "CREATE INDEX question_topic IF NOT EXISTS FOR (n:Question) ON (n.topic)",
+]
+
+graphdb = None
+graphdb_lock = threading.Lock()
+
+
+# returns the process-wide Neo4j driver, it is created on first use (or at application startup)
+def get_graphdb():
+    global graphdb
+    if graphdb is None:
+        with graphdb_lock:
+            if graphdb is None:
+                graphdb = GraphDatabase.driver(uri=neo4j["host"], auth=(neo4j["user"], neo4j["password"]),
+                                               max_connection_pool_size=NEO4J_MAX_CONNECTION_POOL_SIZE)
+    return graphdb
+
+
+def close_graphdb():
+    global graphdb
+    with graphdb_lock:
+        if graphdb is not None:
+            graphdb.close()
+            graphdb = None
+
+
+def create_indexes():
+    with get_graphdb().session() as session:
+        for index in NEO4J_INDEXES:
+            session.run(index).consume()
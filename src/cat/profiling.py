@@ -0,0 +1,331 @@
+import collections
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from src.cat.async_db_connector import ar
+
+# On-demand profiling of the CAT engine calls (create_quiz, get_next_question, get_result). A call is profiled if the
+# request has the header PROFILING_HEADER (value: "sampling" or "cprofile") or if it is picked with the sample rate
+# set through the admin endpoint (0 = off, the default). The blocking engine work of a profiled call (estimation,
+# selection, Neo4j fetch, ...) runs under a profiler:
+#   sampling: a background thread samples the stack of the working thread every PROFILING_SAMPLE_INTERVAL seconds,
+#             the profile contains the collapsed stacks ("frame;frame;frame count", the input of flamegraph tools)
+#   cprofile: deterministic profile of every function call, the profile contains the pstats report
+# The profiles of all processes are kept in a ring buffer in Redis, the last PROFILING_BUFFER_SIZE can be downloaded.
+# Profiling is off unless an admin token is set with the environment variable ADMIN_TOKEN_ENV: the profiling header
+# is only used for requests with the token in ADMIN_TOKEN_HEADER, which the admin endpoints require as well.
+
+PROFILING_HEADER = "x-cat-profile"
+
+ADMIN_TOKEN_ENV = "CAT_ADMIN_TOKEN"
+ADMIN_TOKEN_HEADER = "x-cat-admin-token"
+PROFILING_MODES = ("sampling", "cprofile")
+
+PROFILING_SETTINGS_KEY = "profilingSettings"
+PROFILES_KEY = "profiles"
+
+# number of profiles kept in the ring buffer
+PROFILING_BUFFER_SIZE = 50
+
+# seconds the profiling settings are used before they are read from Redis again
+PROFILING_SETTINGS_TTL = 5
+
+# seconds between two stack samples of the sampling profiler
+PROFILING_SAMPLE_INTERVAL = 0.002
+
+# functions listed in the report of the deterministic profiler
+PROFILING_STATS_LINES = 60
+
+# mode requested by the header of the current request, set by ProfilingMiddleware
+requested_profiling_mode = contextvars.ContextVar("requested_profiling_mode", default=None)
+
+# profile of the call running in the current context (copied into the executor threads by run_in_executor)
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+# --------------- Settings ---------------
+
+class ProfilingSettings:
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.mode = PROFILING_MODES[0]
+        self.fetched_at = None
+
+    def is_stale(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= PROFILING_SETTINGS_TTL
+
+    def set_fields(self, fields: dict):
+        self.sample_rate = float(fields.get(b"sampleRate", 0.0))
+        self.mode = fields.get(b"mode", PROFILING_MODES[0].encode()).decode()
+        self.fetched_at = time.monotonic()
+
+    async def refresh_async(self):
+        if self.is_stale():
+            self.set_fields(await ar.hgetall(PROFILING_SETTINGS_KEY))
+
+    # returns the profiling mode for a new call or None if it is not profiled
+    def pick_mode(self):
+        if not os.environ.get(ADMIN_TOKEN_ENV):  # profiling is off
+            return None
+        mode = requested_profiling_mode.get()
+        if mode is not None:
+            return mode
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return self.mode
+        return None
+
+    def to_dict(self):
+        return {"sampleRate": self.sample_rate, "mode": self.mode}
+
+
+profiling_settings = ProfilingSettings()
+
+
+async def set_profiling_settings_async(sample_rate: float, mode: str):
+    if mode not in PROFILING_MODES:
+        raise ValueError(f"Unknown profiling mode {mode}, use one of {', '.join(PROFILING_MODES)}")
+    await ar.hset(PROFILING_SETTINGS_KEY, mapping={"sampleRate": sample_rate, "mode": mode})
+    profiling_settings.fetched_at = None  # this process uses the new settings immediately
+
+
+# returns whether the given token is the admin token (always False if no admin token is set)
+def is_admin_token(token: str):
+    admin_token = os.environ.get(ADMIN_TOKEN_ENV)
+    return bool(admin_token) and token is not None and hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+# returns the requested profiling mode for the value of the profiling header
+def parse_profiling_header(value: str):
+    value = value.strip().lower()
+    return value if value in PROFILING_MODES else PROFILING_MODES[0]
+
+
+# ASGI middleware reading the profiling header of the requests
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = dict(scope["headers"])
+            profiling_header = headers.get(PROFILING_HEADER.encode())
+            if profiling_header is not None and is_admin_token(headers.get(ADMIN_TOKEN_HEADER.encode(), b"")
+                                                               .decode("latin-1")):
+                token = requested_profiling_mode.set(parse_profiling_header(profiling_header.decode("latin-1")))
+                try:
+                    return await self.app(scope, receive, send)
+                finally:
+                    requested_profiling_mode.reset(token)
+        return await self.app(scope, receive, send)
+
+
+# --------------- Sampling ---------------
+
+# returns the stack of a frame in the collapsed format, outermost frame first (without the frames of the profiler)
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != __file__:
+            names.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# background thread sampling the stacks of the threads running profiled work, it only runs while there are any
+class StackSampler:
+    def __init__(self, interval: float = PROFILING_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.threads = {}  # thread id -> RequestProfile
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def register(self, thread_id: int, profile):
+        with self._lock:
+            self.threads[thread_id] = profile
+            if self._thread is None or not self._thread.is_alive():  # not started yet or lost by a fork
+                self._thread = threading.Thread(target=self.run, daemon=True, name="cat-profiler")
+                self._thread.start()
+            self._wakeup.set()
+
+    def unregister(self, thread_id: int):
+        with self._lock:
+            self.threads.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                threads = dict(self.threads)
+                if not threads:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            for thread_id, profile in threads.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.add_sample(collapse_stack(frame))
+            time.sleep(self.interval)
+
+
+stack_sampler = StackSampler()
+
+# threads currently running profiled work, so nested profiled functions are not profiled twice
+profiled_threads = threading.local()
+
+
+# --------------- Profiles ---------------
+
+# class collecting the profile of one engine call
+class RequestProfile:
+    def __init__(self, name: str, mode: str, labels: dict):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.mode = mode
+        self.labels = labels
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.stacks = collections.Counter()  # collapsed stack -> number of samples
+        self.stats = None  # pstats.Stats of all profiled work
+        self._lock = threading.Lock()  # samples and stats are added by the sampler and the executor threads
+
+    def add_sample(self, stack: str):
+        with self._lock:
+            self.stacks[stack] += 1
+
+    def add_stats(self, profiler: cProfile.Profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+    # runs func in the current thread under the profiler
+    def run(self, func, *args, **kwargs):
+        if getattr(profiled_threads, "active", False):
+            return func(*args, **kwargs)
+        profiled_threads.active = True
+        try:
+            if self.mode == "cprofile":
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(func, *args, **kwargs)
+                finally:
+                    self.add_stats(profiler)
+            thread_id = threading.get_ident()
+            stack_sampler.register(thread_id, self)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack_sampler.unregister(thread_id)
+        finally:
+            profiled_threads.active = False
+
+    def get_report(self):
+        with self._lock:
+            if self.mode == "cprofile":
+                if self.stats is None:
+                    return ""
+                report = io.StringIO()
+                self.stats.stream = report
+                self.stats.sort_stats("cumulative").print_stats(PROFILING_STATS_LINES)
+                return report.getvalue()
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def to_record(self):
+        with self._lock:
+            samples = sum(self.stacks.values())
+        return json.dumps({
+            "id": self.id,
+            "name": self.name,
+            "mode": self.mode,
+            "labels": self.labels,
+            "time": self.time,
+            "duration": time.perf_counter() - self.start,
+            "pid": os.getpid(),
+            "samples": samples,
+            "profile": self.get_report(),
+        })
+
+
+async def store_profile_async(profile: RequestProfile):
+    pipe = ar.pipeline(transaction=True)
+    pipe.lpush(PROFILES_KEY, profile.to_record())
+    pipe.ltrim(PROFILES_KEY, 0, PROFILING_BUFFER_SIZE - 1)
+    await pipe.execute()
+
+
+# returns the stored profiles, newest first, without their reports
+async def get_profiles_async():
+    profiles = [json.loads(record) for record in await ar.lrange(PROFILES_KEY, 0, -1)]
+    for profile in profiles:
+        profile.pop("profile")
+    return profiles
+
+
+# returns the stored profile with the given id or None
+async def get_profile_async(profile_id: str):
+    for record in await ar.lrange(PROFILES_KEY, 0, -1):
+        profile = json.loads(record)
+        if profile["id"] == profile_id:
+            return profile
+    return None
+
+
+# returns the quiz id and topic of the first argument of a profiled call (QuizAPI or QuizState)
+def get_profile_labels(args: tuple):
+    if not args:
+        return {}
+    subject = args[0]
+    if hasattr(subject, "topicId"):  # QuizAPI
+        return {"topicId": subject.topicId}
+    if hasattr(subject, "quiz_id") and "topicId" in subject:  # QuizState
+        return {"quizId": subject.quiz_id, "topicId": subject["topicId"]}
+    return {"quizId": subject}
+
+
+# --------------- Decorators ---------------
+
+# decorator for the engine calls (coroutine functions) that can be profiled; only the work of the functions decorated
+# with profiled_work is profiled (awaiting Redis does not show up, other requests run meanwhile)
+def profiled_call(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def profiled(*args, **kwargs):
+            await profiling_settings.refresh_async()
+            mode = profiling_settings.pick_mode()
+            if mode is None:
+                return await func(*args, **kwargs)
+            profile = RequestProfile(name, mode, get_profile_labels(args))
+            token = current_profile.set(profile)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current_profile.reset(token)
+                await store_profile_async(profile)
+        return profiled
+    return decorator
+
+
+# decorator for blocking work done by the engine calls, it is profiled if the call is profiled
+def profiled_work(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        return profile.run(func, *args, **kwargs)
+    return wrapper
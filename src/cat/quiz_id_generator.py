@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+from src.cat.db_connector import r
+
+# Quiz ids are 63-bit, k-sortable integers (fits the BigInteger QuizLog.quiz_id column):
+#   41 bits milliseconds since QUIZ_ID_EPOCH_MS | 10 bits worker id | 12 bits sequence within the millisecond
+QUIZ_ID_EPOCH_MS = 1672531200000  # 2023-01-01 00:00:00 UTC
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# a fixed worker id can be set per process with this environment variable, otherwise one is leased from Redis
+WORKER_ID_ENV = "CAT_WORKER_ID"
+
+# seconds a leased worker id is reserved, the lease is renewed every third of it
+WORKER_ID_LEASE_TTL = 60
+
+
+def get_r_worker_id_key(worker_id: int):
+    return "quizIdWorker_" + str(worker_id)
+
+
+# class generating collision-free quiz ids without coordination per id
+class QuizIdGenerator:
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID}, got {worker_id}")
+        self.worker_id = worker_id
+        self._last_timestamp = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            timestamp = current_millis()
+            if timestamp < self._last_timestamp:  # clock moved backwards, wait until it caught up
+                timestamp = wait_for_millis(self._last_timestamp)
+            if timestamp == self._last_timestamp:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:  # sequence exhausted for this millisecond
+                    timestamp = wait_for_millis(self._last_timestamp + 1)
+            else:
+                self._sequence = 0
+            self._last_timestamp = timestamp
+            return (((timestamp - QUIZ_ID_EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS))
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+def current_millis():
+    return time.time_ns() // 1_000_000
+
+
+def wait_for_millis(timestamp: int):
+    now = current_millis()
+    while now < timestamp:
+        time.sleep((timestamp - now) / 1000)
+        now = current_millis()
+    return now
+
+
+# --------------- Worker id lease ---------------
+
+# leases a worker id not used by any other running process and keeps renewing the lease in the background
+def lease_worker_id():
+    token = uuid.uuid4().hex
+    start = r.incr("quizIdWorkerCounter")
+    for offset in range(MAX_WORKER_ID + 1):
+        worker_id = (start + offset) & MAX_WORKER_ID
+        if r.set(get_r_worker_id_key(worker_id), token, nx=True, ex=WORKER_ID_LEASE_TTL):
+            renewer = threading.Thread(target=renew_worker_id_lease, args=(worker_id, token), daemon=True,
+                                       name="quiz-id-worker-lease")
+            renewer.start()
+            return worker_id
+    raise RuntimeError("All quiz id worker ids are leased")
+
+
+def renew_worker_id_lease(worker_id: int, token: str):
+    while True:
+        time.sleep(WORKER_ID_LEASE_TTL / 3)
+        try:
+            if r.get(get_r_worker_id_key(worker_id)) not in (None, token.encode()):
+                reset_quiz_id_generator()  # lease lost to another process, lease a new worker id on next use
+                return
+            r.set(get_r_worker_id_key(worker_id), token, ex=WORKER_ID_LEASE_TTL)
+        except RedisError:
+            pass  # retried with the next renewal, the lease is still valid for two more periods
+
+
+generator = None
+generator_pid = None
+generator_lock = threading.Lock()
+
+
+# returns the quiz id generator of this process (re-created after a fork, e.g. by gunicorn)
+def get_quiz_id_generator():
+    global generator, generator_pid
+    if generator is None or generator_pid != os.getpid():
+        with generator_lock:
+            if generator is None or generator_pid != os.getpid():
+                worker_id = os.environ.get(WORKER_ID_ENV)
+                generator = QuizIdGenerator(int(worker_id) if worker_id is not None else lease_worker_id())
+                generator_pid = os.getpid()
+    return generator
+
+
+def next_quiz_id():
+    return get_quiz_id_generator().next_id()
+
+
+def reset_quiz_id_generator():
+    global generator
+    with generator_lock:
+        generator = None
@@ -0,0 +1,442 @@
+import json
+import logging
+import time
+from distutils.util import strtobool
+
+import numpy as np
+from redis.exceptions import RedisError, ResponseError
+
+from src.cat.async_db_connector import ar
+from src.cat.db_connector import r
+from src.cat.item_bank import ItemBank, get_item_bank, get_item_bank_async, queue_expire_item_bank, \
+    store_topic_bank, ITEM_COLUMNS, ITEM_DTYPE
+from src.cat.metrics import timed_stage
+
+
+def parse_bool(value: str):
+    return bool(strtobool(value))
+
+
+# parsers for the scalar fields of a quiz, as stored in the quiz state hash
+STATE_FIELDS = {
+    "maxNumberOfQuestions": int,
+    "minMeasurementAccuracy": float,
+    "inputProficiencyLevel": float,
+    "questionSelector": str,
+    "competencyEstimator": str,
+    "topicId": str,
+    "bankVersion": int,
+    "standardErrorOfEstimation": float,
+    "quizFinished": parse_bool,
+    "estTheta": float,
+    "minDiff": float,
+    "maxDiff": float,
+    "itemIndex": int,
+}
+
+
+# set with the ids of all live quizzes (replaces the list LEGACY_QUIZ_IDS_KEY, see migrate_quiz_ids)
+QUIZ_IDS_KEY = "quizIdSet"
+LEGACY_QUIZ_IDS_KEY = "quizIds"
+
+# administered items and responses are stored as packed little-endian arrays, one value each (before, they were
+# Redis lists of decimal strings, which are still read and rewritten on the next save, see load_quiz_state)
+ITEM_INDEX_DTYPE = np.dtype("<u4")
+RESPONSE_DTYPE = np.dtype("<f4")
+
+# fields stored in keys of their own (<quiz id>_<field>) before the quiz state hash was used
+LEGACY_QUIZ_FIELDS = list(STATE_FIELDS) + ["questions"]
+
+# number of entries moved per round trip by migrate_quiz_ids
+QUIZ_IDS_MIGRATION_BATCH_SIZE = 10000
+
+# seconds a quiz is kept after its last change, every save of the quiz state restarts the expiry of all its keys
+QUIZ_TTL = 24 * 60 * 60
+
+# seconds between two sweeps of the quiz id set and number of quiz ids checked per round trip
+QUIZ_SWEEP_INTERVAL = 10 * 60
+QUIZ_SWEEP_BATCH_SIZE = 1000
+
+# number of live quizzes whose memory is measured by get_quiz_memory_report
+QUIZ_MEMORY_SAMPLE_SIZE = 100
+
+sweeper_logger = logging.getLogger(__name__)
+
+
+def get_r_state_key(quiz_id: int):  # hash with all scalar fields of a quiz
+    return str(quiz_id) + "_state"
+
+
+def get_r_administered_items_key(quiz_id: int):
+    return str(quiz_id) + "_administeredItems"
+
+
+def get_r_responses_key(quiz_id: int):
+    return str(quiz_id) + "_responses"
+
+
+# returns the keys holding the state of a quiz
+def get_quiz_state_keys(quiz_id: int):
+    return [get_r_state_key(quiz_id), get_r_administered_items_key(quiz_id), get_r_responses_key(quiz_id)]
+
+
+# returns the keys with one field each of a quiz written before the quiz state hash was used (legacy quiz)
+def get_legacy_quiz_keys(quiz_id: int):
+    return [str(quiz_id) + "_" + field for field in LEGACY_QUIZ_FIELDS]
+
+
+def get_r_legacy_topic_key(quiz_id: int):  # exists for every legacy quiz that can be migrated
+    return str(quiz_id) + "_topicId"
+
+
+# returns all keys of a quiz, including the keys of a legacy quiz
+def get_quiz_keys(quiz_id: int):
+    return get_quiz_state_keys(quiz_id) + get_legacy_quiz_keys(quiz_id)
+
+
+# class holding the state of a quiz: it is loaded from Redis in one round trip at the start of a request,
+# changed in memory and written back in one MULTI/EXEC at the end
+class QuizState:
+    def __init__(self, quiz_id: int, fields: dict = None, administered_items: np.ndarray = None,
+                 responses: np.ndarray = None):
+        self.quiz_id = quiz_id
+        self.fields = fields if fields is not None else {}
+        # item indices and given answers as float values (read-only views of the loaded Redis values)
+        self.administered_items = administered_items if administered_items is not None \
+            else np.empty(0, dtype=ITEM_INDEX_DTYPE)
+        self.responses = responses if responses is not None else np.empty(0, dtype=RESPONSE_DTYPE)
+        self._changed_fields = set(self.fields)
+        self._new_administered_items = []
+        self._new_responses = []
+        self._legacy_lists = False  # loaded from Redis lists, the values are rewritten on the next save
+
+    # creates the state of a quiz as loaded from Redis (without changes), legacy_lists if the administered items and
+    # responses were stored as Redis lists
+    @classmethod
+    def from_saved(cls, quiz_id: int, fields: dict, administered_items: np.ndarray, responses: np.ndarray,
+                   legacy_lists: bool = False):
+        state = cls(quiz_id, fields, administered_items, responses)
+        state.mark_saved()
+        state._legacy_lists = legacy_lists
+        return state
+
+    def __getitem__(self, field: str):
+        return self.fields[field]
+
+    def __setitem__(self, field: str, value):
+        self.fields[field] = value
+        self._changed_fields.add(field)
+
+    def __contains__(self, field: str):
+        return field in self.fields
+
+    def add_administered_item(self, item_index: int):
+        self.administered_items = np.append(self.administered_items,
+                                            np.array([item_index], dtype=ITEM_INDEX_DTYPE))
+        self._new_administered_items.append(int(item_index))
+
+    def add_response(self, response: float):
+        self.responses = np.append(self.responses, np.array([response], dtype=RESPONSE_DTYPE))
+        self._new_responses.append(float(response))
+
+    def get_administered_items(self):
+        return self.administered_items
+
+    # contains the given answers for the administeredQuestions as boolean values (needed for the catsim library)
+    def get_responses(self):
+        return self.responses == 1.0
+
+    # contains the given answers as float values, rounded to the precision of the stored float32 values (0.7 instead
+    # of 0.699999988079071)
+    def get_responses_as_float(self):
+        return np.array([float(f"{response:.7g}") for response in self.responses])
+
+    def get_item_bank(self):
+        return get_item_bank(self["topicId"], self["bankVersion"])
+
+    async def get_item_bank_async(self):
+        return await get_item_bank_async(self["topicId"], self["bankVersion"])
+
+    # adds all changes to the given pipeline
+    def queue_save(self, pipe):
+        if self._changed_fields:
+            pipe.hset(get_r_state_key(self.quiz_id),
+                      mapping={field: str(self.fields[field]) for field in self._changed_fields})
+        new_administered_items = self._new_administered_items
+        new_responses = self._new_responses
+        if self._legacy_lists:  # replace the lists by packed values with all items and responses
+            pipe.delete(get_r_administered_items_key(self.quiz_id), get_r_responses_key(self.quiz_id))
+            new_administered_items = self.administered_items
+            new_responses = self.responses
+        if len(new_administered_items):
+            pipe.append(get_r_administered_items_key(self.quiz_id),
+                        np.asarray(new_administered_items, dtype=ITEM_INDEX_DTYPE).tobytes())
+        if len(new_responses):
+            pipe.append(get_r_responses_key(self.quiz_id), np.asarray(new_responses, dtype=RESPONSE_DTYPE).tobytes())
+        queue_expire(pipe, self.quiz_id)
+        if "bankVersion" in self.fields:  # the item bank of the quiz must not expire before the quiz
+            queue_expire_item_bank(pipe, self["topicId"], self["bankVersion"], QUIZ_TTL)
+
+    # marks all changes as written
+    def mark_saved(self):
+        self._changed_fields = set()
+        self._new_administered_items = []
+        self._new_responses = []
+        self._legacy_lists = False
+
+    # writes all changes in one MULTI/EXEC, commands added to pipe before are executed in the same transaction
+    @timed_stage("saveState")
+    def save(self, pipe=None):
+        if pipe is None:
+            pipe = r.pipeline(transaction=True)
+        self.queue_save(pipe)
+        pipe.execute()
+        self.mark_saved()
+
+    @timed_stage("saveState")
+    async def save_async(self, pipe=None):
+        if pipe is None:
+            pipe = ar.pipeline(transaction=True)
+        self.queue_save(pipe)
+        await pipe.execute()
+        self.mark_saved()
+
+
+# adds the commands restarting the expiry of the keys of a quiz to the given pipeline (keys not created yet are
+# skipped by Redis, they get their expiry with the save creating them)
+def queue_expire(pipe, quiz_id: int):
+    for key in get_quiz_state_keys(quiz_id):
+        pipe.expire(key, QUIZ_TTL)
+
+
+# adds the commands restarting the expiry of a legacy quiz to the given pipeline
+def queue_expire_legacy(pipe, quiz_id: int):
+    for key in get_legacy_quiz_keys(quiz_id):
+        pipe.expire(key, QUIZ_TTL)
+
+
+# adds the commands deleting a quiz to the given pipeline
+def queue_delete(pipe, quiz_id: int):
+    pipe.delete(*get_quiz_keys(quiz_id))
+    pipe.srem(QUIZ_IDS_KEY, quiz_id)
+
+
+async def delete_quiz_state_async(quiz_id: int):
+    pipe = ar.pipeline(transaction=True)
+    queue_delete(pipe, quiz_id)
+    await pipe.execute()
+
+
+# adds all commands needed to load a quiz state to the given pipeline
+def queue_load(pipe, quiz_id: int):
+    pipe.hgetall(get_r_state_key(quiz_id))
+    pipe.get(get_r_administered_items_key(quiz_id))
+    pipe.get(get_r_responses_key(quiz_id))
+
+
+# returns the positions of the results of queue_load that failed since the values are still stored as Redis lists
+def get_legacy_list_positions(results: list):
+    return [position for position in (1, 2)
+            if isinstance(results[position], ResponseError) and "WRONGTYPE" in str(results[position])]
+
+
+# adds the commands reading the legacy lists at the given positions of the results of queue_load to the given pipeline
+def queue_load_legacy_lists(pipe, quiz_id: int, positions: list):
+    keys = get_quiz_state_keys(quiz_id)
+    for position in positions:
+        pipe.lrange(keys[position], 0, -1)
+
+
+# returns the packed value (or legacy list) of a quiz as array, packed values are not copied
+def decode_values(raw, dtype: np.dtype):
+    if isinstance(raw, Exception):
+        raise raw
+    if isinstance(raw, list):
+        return np.array([float(value) for value in raw], dtype=dtype)
+    return np.frombuffer(raw or b"", dtype=dtype)
+
+
+# creates the quiz state from the results of the commands added by queue_load, returns None if the quiz does not exist
+def parse_quiz_state(quiz_id: int, results: list):
+    fields_raw, administered_items_raw, responses_raw = results
+    if isinstance(fields_raw, Exception):
+        raise fields_raw
+    if not fields_raw:
+        return None
+    fields = {}
+    for field, value in fields_raw.items():
+        field = field.decode("utf-8")
+        fields[field] = STATE_FIELDS.get(field, str)(value.decode("utf-8"))
+    return QuizState.from_saved(quiz_id, fields,
+                                decode_values(administered_items_raw, ITEM_INDEX_DTYPE),
+                                decode_values(responses_raw, RESPONSE_DTYPE),
+                                isinstance(administered_items_raw, list) or isinstance(responses_raw, list))
+
+
+# loads the state of a quiz in a single round trip (two for quizzes stored as lists), returns None if the quiz does
+# not exist
+@timed_stage("loadState")
+def load_quiz_state(quiz_id: int):
+    pipe = r.pipeline(transaction=False)
+    queue_load(pipe, quiz_id)
+    results = pipe.execute(raise_on_error=False)
+    positions = get_legacy_list_positions(results)
+    if positions:
+        pipe = r.pipeline(transaction=False)
+        queue_load_legacy_lists(pipe, quiz_id, positions)
+        for position, values in zip(positions, pipe.execute()):
+            results[position] = values
+    return parse_quiz_state(quiz_id, results)
+
+
+@timed_stage("loadState")
+async def load_quiz_state_async(quiz_id: int):
+    pipe = ar.pipeline(transaction=False)
+    queue_load(pipe, quiz_id)
+    results = await pipe.execute(raise_on_error=False)
+    positions = get_legacy_list_positions(results)
+    if positions:
+        pipe = ar.pipeline(transaction=False)
+        queue_load_legacy_lists(pipe, quiz_id, positions)
+        for position, values in zip(positions, await pipe.execute()):
+            results[position] = values
+    return parse_quiz_state(quiz_id, results)
+
+
+# moves the ids of the legacy quizIds list into the quiz id set, can be run repeatedly
+def migrate_quiz_ids():
+    migrated = 0
+    while True:
+        quiz_ids = r.lrange(LEGACY_QUIZ_IDS_KEY, 0, QUIZ_IDS_MIGRATION_BATCH_SIZE - 1)
+        if not quiz_ids:
+            break
+        pipe = r.pipeline(transaction=True)
+        pipe.sadd(QUIZ_IDS_KEY, *quiz_ids)
+        pipe.ltrim(LEGACY_QUIZ_IDS_KEY, len(quiz_ids), -1)
+        pipe.execute()
+        migrated += len(quiz_ids)
+    return migrated
+
+
+# returns the item bank of the questions stored with a legacy quiz (QuestionAPI objects as JSON)
+def parse_legacy_questions(questions_raw: list):
+    questions = [json.loads(question) for question in questions_raw]
+    items = np.empty([len(questions), ITEM_COLUMNS], dtype=ITEM_DTYPE)
+    for i, question in enumerate(questions):
+        items[i] = (question["discrimination"], question["difficulty"], question["pseudoGuessing"],
+                    question["upperAsymptote"])
+    return ItemBank(items,
+                    [int(question["id"]) for question in questions],
+                    [question["materialId"] for question in questions])
+
+
+# moves the quizzes of the quiz id set stored with one key per field (before the quiz state hash was used) into
+# quiz state hashes, their questions are stored as item bank version of the topic (one per distinct question list);
+# the administered items and responses are rewritten when the quiz is saved next, can be run repeatedly
+def migrate_legacy_quizzes():
+    legacy_fields = [field for field in STATE_FIELDS if field != "bankVersion"]
+    bank_versions = {}  # (topic id, questions) -> bank version
+    migrated = 0
+    cursor = 0
+    while True:
+        cursor, quiz_ids = r.sscan(QUIZ_IDS_KEY, cursor, count=QUIZ_SWEEP_BATCH_SIZE)
+        quiz_ids = [int(quiz_id) for quiz_id in quiz_ids]
+        pipe = r.pipeline(transaction=False)
+        for quiz_id in quiz_ids:
+            pipe.exists(get_r_state_key(quiz_id))
+            pipe.mget([str(quiz_id) + "_" + field for field in legacy_fields])
+            pipe.lrange(str(quiz_id) + "_questions", 0, -1)
+        results = pipe.execute()
+        pipe = r.pipeline(transaction=True)
+        for quiz_id, exists, values, questions_raw in zip(quiz_ids, results[::3], results[1::3], results[2::3]):
+            if exists or values[legacy_fields.index("topicId")] is None or not questions_raw:
+                continue  # already migrated or not a legacy quiz (expired quizzes are removed by the sweeper)
+            fields = {field: STATE_FIELDS[field](value.decode("utf-8"))
+                      for field, value in zip(legacy_fields, values) if value is not None}
+            bank_key = (fields["topicId"], tuple(questions_raw))
+            if bank_key not in bank_versions:
+                bank_versions[bank_key] = store_topic_bank(fields["topicId"], parse_legacy_questions(questions_raw))
+            fields["bankVersion"] = bank_versions[bank_key]
+            pipe.hset(get_r_state_key(quiz_id), mapping={field: str(value) for field, value in fields.items()})
+            pipe.delete(*get_legacy_quiz_keys(quiz_id))
+            queue_expire(pipe, quiz_id)
+            queue_expire_item_bank(pipe, fields["topicId"], fields["bankVersion"], QUIZ_TTL)
+            migrated += 1
+        pipe.execute()
+        if cursor == 0:
+            return migrated
+
+
+# --------------- Sweeper ---------------
+
+# removes the ids of expired quizzes from the quiz id set (with the keys left behind by them) and sets the expiry of
+# quizzes saved before quizzes expired, returns the number of removed ids and of quizzes given an expiry. Legacy
+# quizzes not migrated yet (see migrate_legacy_quizzes) are kept until they expired, they are given an expiry too.
+def sweep_quiz_ids():
+    removed = 0
+    expiring = 0
+    cursor = 0
+    while True:
+        cursor, quiz_ids = r.sscan(QUIZ_IDS_KEY, cursor, count=QUIZ_SWEEP_BATCH_SIZE)
+        if quiz_ids:
+            quiz_ids = [int(quiz_id) for quiz_id in quiz_ids]
+            pipe = r.pipeline(transaction=False)
+            for quiz_id in quiz_ids:
+                pipe.ttl(get_r_state_key(quiz_id))
+            ttls = pipe.execute()
+            missing_quiz_ids = [quiz_id for quiz_id, ttl in zip(quiz_ids, ttls) if ttl == -2]  # no state hash
+            pipe = r.pipeline(transaction=False)
+            for quiz_id in missing_quiz_ids:
+                pipe.ttl(get_r_legacy_topic_key(quiz_id))
+            legacy_ttls = pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            for quiz_id, ttl in zip(quiz_ids, ttls):
+                if ttl == -1:  # saved without expiry
+                    queue_expire(pipe, quiz_id)
+                    expiring += 1
+            for quiz_id, legacy_ttl in zip(missing_quiz_ids, legacy_ttls):
+                if legacy_ttl == -2:  # expired (or never saved)
+                    queue_delete(pipe, quiz_id)
+                    removed += 1
+                elif legacy_ttl == -1:  # legacy quiz saved without expiry
+                    queue_expire_legacy(pipe, quiz_id)
+                    expiring += 1
+            pipe.execute()
+        if cursor == 0:
+            return removed, expiring
+
+
+# runs the sweeper until it is stopped
+def run_quiz_sweeper():
+    while True:
+        try:
+            removed, expiring = sweep_quiz_ids()
+            sweeper_logger.info("Removed %d expired quiz ids, set the expiry of %d quizzes", removed, expiring)
+        except RedisError:
+            sweeper_logger.exception("Quiz sweep failed")
+        time.sleep(QUIZ_SWEEP_INTERVAL)
+
+
+# returns the number of live quizzes and the memory used by them, measured on a random sample of the live quizzes
+def get_quiz_memory_report(sample_size: int = QUIZ_MEMORY_SAMPLE_SIZE):
+    live_quizzes = r.scard(QUIZ_IDS_KEY)
+    quiz_ids = [int(quiz_id) for quiz_id in r.srandmember(QUIZ_IDS_KEY, sample_size) or []]
+    pipe = r.pipeline(transaction=False)
+    for quiz_id in quiz_ids:
+        for key in get_quiz_state_keys(quiz_id):
+            pipe.memory_usage(key, samples=0)  # 0: all fields of the hash are measured
+    usages = np.array([usage or 0 for usage in pipe.execute()], dtype=float).reshape(len(quiz_ids), 3)
+    bytes_per_quiz = usages.sum(axis=1)
+    report = {"liveQuizzes": live_quizzes, "sampledQuizzes": len(quiz_ids)}
+    if len(quiz_ids):
+        report.update({
+            "bytesPerQuiz": {"mean": float(bytes_per_quiz.mean()),
+                             "p50": float(np.percentile(bytes_per_quiz, 50)),
+                             "p95": float(np.percentile(bytes_per_quiz, 95)),
+                             "max": float(bytes_per_quiz.max())},
+            "bytesPerKey": {"state": float(usages[:, 0].mean()),
+                            "administeredItems": float(usages[:, 1].mean()),
+                            "responses": float(usages[:, 2].mean())},
+            "estimatedTotalBytes": float(bytes_per_quiz.mean() * live_quizzes),
+        })
+    return report
@@ -0,0 +1,141 @@
+from warnings import warn
+
+import numpy as np
+from catsim import irt
+from catsim.simulation import Selector
+
+from src.cat.item_bank import ItemBank
+
+
+# class holding the items of a bank sorted by the theta value where they are most informative, built once per bank
+# so the next item is found with a bisect instead of sorting the whole bank on every answer
+class SelectionIndex:
+    def __init__(self, peaks: np.ndarray):
+        self.order = np.argsort(peaks, kind="stable")  # item indices sorted by peak
+        self.peaks = np.ascontiguousarray(peaks[self.order])  # sorted peaks
+
+    # returns the non-administered item whose peak is nearest to theta (ties go to the lower item index, like a
+    # stable sort of the distances) or None if all items were administered
+    def nearest(self, theta: float, administered_items):
+        n = len(self.order)
+        administered = np.zeros(n, dtype=bool)
+        administered[np.asarray(administered_items, dtype=int)] = True
+        hi = int(np.searchsorted(self.peaks, theta))
+        lo = hi - 1
+        # skip administered items on both sides, at most len(administered_items) steps in total
+        while lo >= 0 and administered[self.order[lo]]:
+            lo -= 1
+        while hi < n and administered[self.order[hi]]:
+            hi += 1
+        nearest_peaks = [self.peaks[position] for position in (lo, hi) if 0 <= position < n]
+        if not nearest_peaks:
+            return None
+        distance = min(abs(peak - theta) for peak in nearest_peaks)
+        return min(self.first_available(peak, administered) for peak in nearest_peaks
+                   if abs(peak - theta) == distance)
+
+    # returns the lowest non-administered item index with the given peak (the order is stable, so items with equal
+    # peaks are sorted by index)
+    def first_available(self, peak: float, administered: np.ndarray):
+        start = int(np.searchsorted(self.peaks, peak, side="left"))
+        end = int(np.searchsorted(self.peaks, peak, side="right"))
+        for position in range(start, end):
+            if not administered[self.order[position]]:
+                return int(self.order[position])
+
+
+# returns True if all items have the same information curve shifted by their difficulty (same discrimination, no
+# pseudo guessing, upper asymptote 1): then the most informative item at theta is the one with the nearest difficulty.
+# irt.detect_model cannot be used for this, catsim 0.15 returns 2 if all discriminations are equal.
+def has_equal_information_curves(items: np.ndarray):
+    return bool(np.all(items[:, 0] == items[0, 0]) and np.all(items[:, 2] == 0) and np.all(items[:, 3] == 1))
+
+
+# returns the index of the item bank sorted by difficulty, cached on the bank. With by_information=True, None is
+# returned if the items differ in more than their difficulty, because the nearest difficulty is not the most
+# informative item then.
+def get_selection_index(bank: ItemBank, by_information: bool):
+    key = "information" if by_information else "difficulty"
+    if key not in bank.selection_indexes:
+        if by_information and not has_equal_information_curves(bank.items):
+            index = None
+        else:
+            index = SelectionIndex(np.asarray(bank.items[:, 1], dtype=float))
+        bank.selection_indexes[key] = index
+    return bank.selection_indexes[key]
+
+
+# returns the selector choosing the most informative non-administered item: the IndexedSelector if the bank allows it,
+# otherwise the MaxInformationSelector
+def get_max_info_selector(bank: ItemBank):
+    if get_selection_index(bank, by_information=True) is not None:
+        return IndexedSelector(bank, by_information=True)
+    return MaxInformationSelector()
+
+
+class IndexedSelector(Selector):
+    """Selector returning the first non-administered item of an item bank nearest to the estimated theta, using
+    the precomputed :py:class:`SelectionIndex` of the bank
+
+    :param bank: the item bank of the quiz, the items passed to :py:meth:`select` must be the items of this bank
+    :param by_information: if True, the most informative item is selected, which requires items differing in their
+                           difficulty only (see :py:func:`get_selection_index`), otherwise the item is selected like
+                           in :py:class:`catsim.selection.UrrySelector`
+    """
+
+    def __init__(self, bank: ItemBank, by_information: bool):
+        super().__init__()
+        self._index = get_selection_index(bank, by_information)
+        if self._index is None:
+            raise ValueError('The items differ in more than their difficulty, use the MaxInformationSelector.')
+        self._by_information = by_information
+
+    def __str__(self):
+        return 'Indexed Maximum Information Selector' if self._by_information else 'Indexed Urry Selector'
+
+    def select(self, index: int = None, items: np.ndarray = None, administered_items: list = None,
+               est_theta: float = None, **kwargs) -> int:
+        if (index is None or self.simulator is None) and (administered_items is None or est_theta is None):
+            raise ValueError(
+                'Either pass an index for the simulator or all of the other optional parameters to use this '
+                'component independently.')
+
+        if administered_items is None and est_theta is None:
+            administered_items = self.simulator.administered_items[index]
+            est_theta = self.simulator.latest_estimations[index]
+
+        selected_item = self._index.nearest(est_theta, administered_items)
+        if selected_item is None:
+            warn('There are no more items to be applied.')
+        return selected_item
+
+
+class MaxInformationSelector(Selector):
+    """Selector returning the non-administered item with the maximum information at the estimated theta (ties go to
+    the lower item index), computed for all items of the bank on every selection
+    """
+
+    def __str__(self):
+        return 'Maximum Information Selector'
+
+    def select(self, index: int = None, items: np.ndarray = None, administered_items: list = None,
+               est_theta: float = None, **kwargs) -> int:
+        if (index is None or self.simulator is None) and (
+                items is None or administered_items is None or est_theta is None):
+            raise ValueError(
+                'Either pass an index for the simulator or all of the other optional parameters to use this '
+                'component independently.')
+
+        if items is None and administered_items is None and est_theta is None:
+            items = self.simulator.items
+            administered_items = self.simulator.administered_items[index]
+            est_theta = self.simulator.latest_estimations[index]
+
+        # nan where the probability of a correct answer rounds to 0 or 1, the item gives no information there
+        information = np.nan_to_num(irt.inf(est_theta, items[:, 0], items[:, 1], items[:, 2], items[:, 3]), nan=0.0)
+        information[np.asarray(administered_items, dtype=int)] = -np.inf
+        selected_item = int(np.argmax(information))
+        if information[selected_item] == -np.inf:
+            warn('There are no more items to be applied.')
+            return None
+        return selected_item
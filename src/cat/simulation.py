@@ -0,0 +1,191 @@
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from catsim import irt
+
+import config
+from src.cat.cat_engine import get_estimator, get_item_bank_of_topic, get_selector, init_estimator, init_initializer
+from src.cat.item_bank import ItemBank, get_current_topic_bank_version, get_item_bank
+from src.cat.quiz_state import QuizState
+from src.models.fastapi_models import QuizAPI
+
+# Offline simulation of adaptive quizzes for choosing the stopping rules (minMeasurementAccuracy and
+# maxNumberOfQuestions) of a topic. Simulated examinees with a known competency answer the questions of the topic's
+# item bank; the questions are selected and the competency is estimated like in cat_engine.advance_quiz (same
+# get_selector/get_estimator and stopping rules). The choices of the engine before a quiz stops do not depend on the
+# stopping rules, so every examinee is simulated once up to the largest maxNumberOfQuestions and all combinations
+# of stopping rules are evaluated on the recorded estimates afterwards. Examinees are simulated in chunks in a
+# process pool. Within a chunk, only the answers and standard errors of all examinees are computed together with
+# NumPy; the next question is selected and the competency is estimated for one examinee at a time, with the
+# engine's selector and estimator, so these steps cost as much per examinee as in a real quiz.
+
+# examinees simulated together by one worker process
+SIMULATION_CHUNK_SIZE = 250
+
+# percentiles reported for the distributions of test length, SEE and bias
+SIMULATION_PERCENTILES = [5, 25, 50, 75, 95]
+
+
+# quiz state of a simulated examinee, holding its item bank in memory instead of loading it from Redis
+class SimulatedQuizState(QuizState):
+    def __init__(self, bank: ItemBank, fields: dict):
+        super().__init__(0, fields)
+        self.bank = bank
+
+    def get_item_bank(self):
+        return self.bank
+
+
+# settings of the simulated quizzes, as for the creation of a quiz
+def get_quiz_api(topic_id: str, question_selector: str, competency_estimator: str):
+    return QuizAPI(topicId=topic_id, questionSelector=question_selector, competencyEstimator=competency_estimator,
+                   inputProficiencyLevel=config.defaultAdaptiveQuiz["inputProficiencyLevel"])
+
+
+# returns the current item bank of the topic, it is fetched from Neo4j if the topic has no current item bank
+def load_simulation_bank(topic_id: str):
+    return get_item_bank(topic_id, get_current_topic_bank_version(topic_id, get_item_bank_of_topic))
+
+
+# returns the standard errors of estimation of all examinees, administered holds the item parameters per examinee
+# (same as irt.see for each examinee)
+def standard_errors(thetas: np.ndarray, administered: np.ndarray):
+    a, b, c, d = administered[..., 0], administered[..., 1], administered[..., 2], administered[..., 3]
+    p = c + (d - c) / (1 + np.exp(-a * (thetas[:, None] - b)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        information = np.sum((a ** 2 * (p - c) ** 2 * (d - p) ** 2) / ((d - c) ** 2 * p * (1 - p)), axis=1)
+        return np.where(information > 0, np.sqrt(1 / information), np.inf)
+
+
+# simulates the quizzes of some examinees up to max_questions answers, returns the estimated competencies and
+# standard errors after each answer (one row per examinee); the answers and standard errors of a step are computed
+# for all examinees at once, the selection and estimation per examinee
+def simulate_chunk(bank: ItemBank, quiz_api: QuizAPI, max_questions: int, true_thetas: np.ndarray, seed: int):
+    rng = np.random.default_rng(seed)
+    random.seed(seed)  # used by init_initializer
+    items = bank.items
+    examinees = len(true_thetas)
+
+    states = []
+    for _ in range(examinees):  # initialized like a new quiz
+        state = SimulatedQuizState(bank, {"questionSelector": quiz_api.questionSelector,
+                                          "competencyEstimator": quiz_api.competencyEstimator})
+        init_initializer(quiz_api, state)
+        init_estimator(quiz_api, state)
+        states.append(state)
+    selector = get_selector(states[0])  # selectors and estimators only depend on the bank and the settings
+    estimator = get_estimator(states[0])
+
+    est_thetas = np.array([state["estTheta"] for state in states])
+    administered_items = np.empty((examinees, max_questions), dtype=int)
+    responses = np.empty((examinees, max_questions), dtype=bool)
+    estimates = np.empty((examinees, max_questions))
+    errors = np.empty((examinees, max_questions))
+    for step in range(max_questions):
+        for examinee in range(examinees):
+            administered_items[examinee, step] = selector.select(
+                items=items, administered_items=administered_items[examinee, :step], est_theta=est_thetas[examinee])
+        selected = items[administered_items[:, step]]
+        responses[:, step] = rng.random(examinees) < irt.icc(true_thetas, selected[:, 0], selected[:, 1],
+                                                             selected[:, 2], selected[:, 3])
+        for examinee in range(examinees):
+            est_thetas[examinee] = estimator.estimate(items=items,
+                                                      administered_items=administered_items[examinee, :step + 1],
+                                                      response_vector=responses[examinee, :step + 1],
+                                                      est_theta=est_thetas[examinee])
+        estimates[:, step] = est_thetas
+        errors[:, step] = standard_errors(est_thetas, items[administered_items[:, :step + 1]])
+    return estimates, errors
+
+
+def get_distribution(values: np.ndarray):
+    distribution = {"mean": float(np.mean(values)), "sd": float(np.std(values))}
+    distribution.update({f"p{percentile}": float(value)
+                         for percentile, value in zip(SIMULATION_PERCENTILES,
+                                                      np.percentile(values, SIMULATION_PERCENTILES))})
+    return distribution
+
+
+# applies the stopping rules of the engine to the recorded quizzes: a quiz stops after the first answer with a
+# standard error below min_accuracy or after max_questions answers
+def evaluate_stopping_rule(true_thetas: np.ndarray, estimates: np.ndarray, errors: np.ndarray, min_accuracy: float,
+                           max_questions: int):
+    accurate = errors[:, :max_questions] < min_accuracy
+    lengths = np.where(accurate.any(axis=1), accurate.argmax(axis=1) + 1, max_questions)
+    rows = np.arange(len(true_thetas))
+    final_estimates = estimates[rows, lengths - 1]
+    final_errors = errors[rows, lengths - 1]
+    bias = final_estimates - true_thetas
+    return {
+        "minMeasurementAccuracy": min_accuracy,
+        "maxNumberOfQuestions": max_questions,
+        "stoppedByAccuracy": float(np.mean(accurate.any(axis=1))),
+        "testLength": dict(get_distribution(lengths),
+                           histogram=np.bincount(lengths, minlength=max_questions + 1)[1:].tolist()),
+        "standardError": get_distribution(final_errors),
+        "bias": get_distribution(bias),
+        "rmse": float(np.sqrt(np.mean(bias ** 2))),
+    }
+
+
+# simulates the quizzes of the topic for all combinations of the stopping rules and returns the distributions of
+# test length, standard error and bias per combination
+def simulate_topic(topic_id: str, examinees: int, min_accuracies: list, max_questions: list,
+                   question_selector: str = None, competency_estimator: str = None, theta_mean: float = None,
+                   theta_sd: float = None, workers: int = None, seed: int = 0):
+    quiz_api = get_quiz_api(topic_id,
+                            question_selector or config.defaultAdaptiveQuiz["questionSelector"],
+                            competency_estimator or config.defaultAdaptiveQuiz["competencyEstimator"])
+    if quiz_api.questionSelector == "linearSelector":
+        raise ValueError("Only adaptive quizzes can be simulated, classic quizzes have no stopping rules")
+    bank = load_simulation_bank(topic_id)
+    max_simulated_questions = min(max(max_questions), len(bank))
+    # by default, the competencies of the examinees are distributed like the difficulties of the questions
+    difficulties = bank.items[:, 1]
+    theta_mean = float(np.mean(difficulties)) if theta_mean is None else theta_mean
+    theta_sd = float(np.std(difficulties)) if theta_sd is None else theta_sd
+
+    seed_sequence = np.random.SeedSequence(seed)
+    true_thetas = np.random.default_rng(seed_sequence.spawn(1)[0]).normal(theta_mean, theta_sd, examinees)
+    chunks = [true_thetas[start:start + SIMULATION_CHUNK_SIZE]
+              for start in range(0, examinees, SIMULATION_CHUNK_SIZE)]
+    chunk_seeds = [int(child.generate_state(1)[0]) for child in seed_sequence.spawn(len(chunks))]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = list(pool.map(simulate_chunk, [bank] * len(chunks), [quiz_api] * len(chunks),
+                                [max_simulated_questions] * len(chunks), chunks, chunk_seeds))
+    estimates = np.concatenate([chunk_estimates for chunk_estimates, _ in results])
+    errors = np.concatenate([chunk_errors for _, chunk_errors in results])
+
+    return {
+        "topicId": topic_id,
+        "items": len(bank),
+        "examinees": examinees,
+        "questionSelector": quiz_api.questionSelector,
+        "competencyEstimator": quiz_api.competencyEstimator,
+        "thetaMean": theta_mean,
+        "thetaSd": theta_sd,
+        "stoppingRules": [evaluate_stopping_rule(true_thetas, estimates, errors, min_accuracy,
+                                                 min(max_number, max_simulated_questions))
+                          for max_number in max_questions for min_accuracy in min_accuracies],
+    }
+
+
+def write_simulation_report(report: dict, output_file: str):
+    with open(output_file, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def print_simulation_report(report: dict):
+    print(f"{report['examinees']} examinees, topic {report['topicId']} ({report['items']} items), "
+          f"{report['questionSelector']}, {report['competencyEstimator']}, "
+          f"theta ~ N({report['thetaMean']:.2f}, {report['thetaSd']:.2f})")
+    print(f"{'minAcc':>7} {'maxQ':>5} {'length mean':>12} {'p50':>5} {'p95':>5} {'acc stop':>9} {'SEE mean':>9} "
+          f"{'bias':>8} {'RMSE':>8}")
+    for rule in report["stoppingRules"]:
+        print(f"{rule['minMeasurementAccuracy']:>7.2f} {rule['maxNumberOfQuestions']:>5} "
+              f"{rule['testLength']['mean']:>12.1f} {rule['testLength']['p50']:>5.0f} "
+              f"{rule['testLength']['p95']:>5.0f} {rule['stoppedByAccuracy'] * 100:>8.1f}% "
+              f"{rule['standardError']['mean']:>9.3f} {rule['bias']['mean']:>+8.3f} {rule['rmse']:>8.3f}")
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from src.cat.async_db_connector import AsyncSessionLocal
+from src.cat.db_session import session_scope
+from src.models.sqlalchemy_models import Difficulty
+
+# seconds the question counts of the topics are used before they are queried again
+TOPIC_STATISTICS_TTL = 60
+
+statistics_logger = logging.getLogger(__name__)
+
+TOPIC_COUNTS_QUERY = select(Difficulty.topic_id, func.count(Difficulty.topic_id)).group_by(Difficulty.topic_id) \
+    .order_by(func.count(Difficulty.topic_id).desc())
+
+
+# returns a list of tuples (topics, nr of questions in that topic) ordered by nr of questions in descending order
+def query_topic_counts():
+    with session_scope() as session:
+        return [tuple(row) for row in session.execute(TOPIC_COUNTS_QUERY).all()]
+
+
+async def query_topic_counts_async():
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(TOPIC_COUNTS_QUERY)
+        return [tuple(row) for row in result.all()]
+
+
+# class keeping the question counts of all topics in memory. They are queried again when they are older than the
+# TTL. Only one query runs at a time (single flight); while the counts are refreshed in the background, callers get
+# the previous counts.
+class TopicStatistics:
+    def __init__(self, ttl: float = TOPIC_STATISTICS_TTL):
+        self.ttl = ttl
+        self.topics = None  # list of tuples (topic_id, count), ordered by count in descending order
+        self.counts = {}  # topic_id -> count
+        self.fetched_at = None
+        self._lock = threading.Lock()
+        self._refresh_task = None
+
+    def is_stale(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    def set_topics(self, topics: list):
+        self.topics = topics
+        self.counts = dict(topics)
+        self.fetched_at = time.monotonic()
+
+    def get_topics(self):
+        if self.topics is None or self.is_stale():
+            with self._lock:
+                if self.topics is None or self.is_stale():  # not refreshed while waiting for the lock
+                    self.set_topics(query_topic_counts())
+        return self.topics
+
+    async def get_topics_async(self):
+        if self.topics is None:  # nothing to serve yet, wait for the first query
+            await asyncio.shield(self.start_refresh())
+        elif self.is_stale():
+            self.start_refresh()
+        return self.topics
+
+    def get_count(self, topic_id: str):
+        self.get_topics()
+        return self.counts.get(topic_id, 0)
+
+    # starts a background refresh unless one is already running, returns its task
+    def start_refresh(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self.refresh_async())
+            self._refresh_task.add_done_callback(self.refresh_done)
+        return self._refresh_task
+
+    async def refresh_async(self):
+        self.set_topics(await query_topic_counts_async())
+
+    def refresh_done(self, task: asyncio.Task):
+        self._refresh_task = None
+        if not task.cancelled() and task.exception() is not None and self.topics is not None:
+            statistics_logger.error("Refreshing the topic statistics failed", exc_info=task.exception())
+
+
+topic_statistics = TopicStatistics()
@@ -1,10 +1,10 @@
+import asyncio
 import urllib
-from distutils.util import strtobool
 
 import requests
 from fastapi import HTTPException, Form
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, BackgroundTasks, Depends, Header
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 
 from starlette.responses import RedirectResponse
@@ -12,18 +12,46 @@ from starlette.responses import RedirectResponse
 import config
 import src.cat.cat_engine as ce
 import src.cat.cat_engine_logging
-from src.cat.db_connector import r
-from src.models.fastapi_models import QuizAPI, AnswerAPI, QuizIdAPI
+from src.cat.async_db_connector import ar
+from src.cat.calibration import CALIBRATION_STREAM_KEY
+from src.cat.concurrency import run_in_executor
+from src.cat.metrics import RequestDurationMiddleware, METRICS_QUIZZES_CALIBRATED_KEY, METRICS_CALIBRATION_FLUSHES_KEY, \
+    METRICS_CALIBRATION_FLUSH_SECONDS_KEY, flush_metrics_async, queue_load_metrics, render_calibration_metrics, \
+    render_metrics, run_metrics_flusher
+from src.cat.neo4j_connector import get_graphdb, close_graphdb
+from src.cat.profiling import ProfilingMiddleware, get_profile_async, get_profiles_async, is_admin_token, \
+    profiling_settings, set_profiling_settings_async
+from src.cat.quiz_id_generator import get_quiz_id_generator
+from src.cat.quiz_state import load_quiz_state_async, get_quiz_memory_report
+from src.models.fastapi_models import QuizAPI, AnswerAPI, QuizIdAPI, ProfilingAPI
 
 CATModule = FastAPI()  # Used for REST API
+CATModule.add_middleware(RequestDurationMiddleware)
+CATModule.add_middleware(ProfilingMiddleware)
 templates = Jinja2Templates(directory="templates")
 
 
+@CATModule.on_event("startup")
+async def startup():
+    get_graphdb()  # create the pooled Neo4j driver once per worker
+    await run_in_executor(get_quiz_id_generator)  # lease the worker id used for quiz ids
+    CATModule.state.metrics_flusher = asyncio.ensure_future(run_metrics_flusher())  # once per worker
+
+
+@CATModule.on_event("shutdown")
+async def shutdown():
+    CATModule.state.metrics_flusher.cancel()
+    try:
+        await flush_metrics_async()  # observations since the last flush
+    finally:
+        close_graphdb()
+
+
 # --------------- REST CALLS ---------------
 
 @CATModule.get('/', response_class=HTMLResponse)
 async def get_form(request: Request):
-    topics = ce.get_all_topics_count()  # topics = list of tuples (topic, nr of questions)
+    topics = await ce.get_all_topics_count_async()  # topics = list of tuples (topic, nr of questions)
     return templates.TemplateResponse("home.html", {"request": request, "topics": topics})
 
 
@@ -31,21 +59,97 @@ async def get_form(request: Request):
 async def post_form(topic: str = Form(...), denominator: float = Form(...), update_rate: float = Form(...), mode: str = Form(...)):
     url = f'{config.API_URL}/quizzes'
     body = {"topic": topic, "mode": mode, "language": "en-US"}
-    response = requests.post(url, body)
+    response = await run_in_executor(requests.post, url, body)
     response.raise_for_status()
     response_json = response.json()
     ggb_page = f'{config.FRONTEND_URL}/q/' + f"{response_json['id']}?quizToken={urllib.parse.quote(response_json['token'])}"
     # MST-21 Careful, workaround: this sets the denominator (d) and update rate (k) globally and not per quiz!
     # TODO: d and k must be sent to GGB and then be sent back to us + maybe add a few more placeholders just in case
-    ce.set_calibration_params(denominator, update_rate)
+    await ce.set_calibration_params_async(denominator, update_rate)
     question_redirect = RedirectResponse(ggb_page)
     return question_redirect
 
 @CATModule.get('/update-log-database',
-               summary="Updates the log database with the log file",
+               status_code=202,
+               summary="Starts inserting the new lines of the log file into the log database",
                tags=["log"])
-async def update_log_database():
-    return src.cat.cat_engine_logging.log_to_database()
+async def update_log_database(background_tasks: BackgroundTasks):
+    # runs after the response was sent, logs can also be inserted continuously with: python setup.py ingest_logs
+    background_tasks.add_task(src.cat.cat_engine_logging.log_to_database)
+    return "Log database update started"
+
+
+@CATModule.get('/metrics',
+               response_class=PlainTextResponse,
+               summary="Metrics of the CAT engine in the Prometheus text format",
+               tags=["metrics"])
+async def get_metrics():
+    await flush_metrics_async()  # include the latest observations of this worker
+    pipe = ar.pipeline(transaction=False)
+    queue_load_metrics(pipe)
+    pipe.mget(METRICS_QUIZZES_CALIBRATED_KEY, METRICS_CALIBRATION_FLUSHES_KEY, METRICS_CALIBRATION_FLUSH_SECONDS_KEY)
+    pipe.xlen(CALIBRATION_STREAM_KEY)
+    *totals, calibration_counters, queued_jobs = await pipe.execute()
+    return render_metrics(totals, render_calibration_metrics(*calibration_counters, queued_jobs))
+
+
+# dependency of the admin endpoints, they are only available with the admin token (see src.cat.profiling)
+async def require_admin_token(x_cat_admin_token: str = Header(None)):
+    if not is_admin_token(x_cat_admin_token):
+        raise HTTPException(status_code=403, detail="The admin endpoints require the header X-CAT-Admin-Token")
+
+
+@CATModule.put('/admin/profiling',
+               summary="Set the share of the engine calls that are profiled",
+               tags=["admin"],
+               dependencies=[Depends(require_admin_token)])
+async def set_profiling(profiling_api: ProfilingAPI):
+    """
+    Profile a share of the calls creating quizzes, getting the next question or the result (of all workers):
+
+    - **sampleRate**: Share of the calls that are profiled, between 0.0 (off) and 1.0. Single requests can also be
+      profiled with the header X-CAT-Profile: sampling (or cprofile), along with the admin token.
+    - **mode**: 'sampling' samples the stack every 2 ms (collapsed stacks, e.g. for flamegraph.pl or speedscope),
+      'cprofile' records every function call (pstats report, slows the call down considerably).
+    """
+    if not 0.0 <= profiling_api.sampleRate <= 1.0:
+        raise HTTPException(status_code=422, detail="sampleRate must be between 0.0 and 1.0")
+    try:
+        await set_profiling_settings_async(profiling_api.sampleRate, profiling_api.mode)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    return profiling_api
+
+
+@CATModule.get('/admin/profiling', summary="Get the profiling settings", tags=["admin"],
+               dependencies=[Depends(require_admin_token)])
+async def get_profiling():
+    await profiling_settings.refresh_async()
+    return profiling_settings.to_dict()
+
+
+@CATModule.get('/admin/profiles', summary="List the last profiles (newest first)", tags=["admin"],
+               dependencies=[Depends(require_admin_token)])
+async def get_profiles():
+    return await get_profiles_async()
+
+
+@CATModule.get('/admin/profiles/{profile_id}',
+               response_class=PlainTextResponse,
+               summary="Download a profile (collapsed stacks or pstats report)",
+               tags=["admin"],
+               dependencies=[Depends(require_admin_token)])
+async def get_profile(profile_id: str):
+    profile = await get_profile_async(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile with id " + profile_id + " not found!")
+    return profile["profile"]
+
+
+@CATModule.get('/admin/quizMemory', summary="Get the Redis memory used by the live quizzes", tags=["admin"],
+               dependencies=[Depends(require_admin_token)])
+async def get_quiz_memory():
+    return await run_in_executor(get_quiz_memory_report)
 
 
 @CATModule.post("/quiz",
@@ -61,7 +165,7 @@ async def api_create_quiz(quiz_api: QuizAPI):
     - **maxNumberOfQuestions**: The maximum amount of questions for the quiz. This will be used as a stopping criteria for the exam.
     - **minMeasurementAccuracy**: The threshold for the Standard Error of Estimation. This will be used as a stopping criteria for the exam.
     - **questionSelector**: Defines how the next question is selected. 'maxInfoSelector' represents the Maximum Information Selector (https://douglasrizzo.com.br/catsim/selection.html#catsim.selection.MaxInfoSelector) for adaptive quizzes. This is also the default.
-    - **competencyEstimator**: Defines how the competency is calculated. 'differentialEvolutionEstimator' is the default Estimator, no others are currently implemented.
+    - **competencyEstimator**: Defines how the competency is calculated. 'differentialEvolutionEstimator' is the default Estimator, 'newtonRaphsonEstimator' is a much faster maximum likelihood estimator giving the same results.
     - **topicId**: The ID of the topic from which questions should be taken.
     - **questions**: Not necessary, list of questions will be automatically created by topicID.
 
@@ -94,7 +198,7 @@ async def api_create_quiz(quiz_api: QuizAPI):
     """
     # TODO (old) validate maxNumberOfQuestions -> It must be less or equal
     # than the number of given questions
-    return ce.create_quiz(quiz_api)
+    return await ce.create_quiz_async(quiz_api)
 
 
 @CATModule.post("/quiz/{quiz_id}/question",
@@ -115,13 +219,14 @@ async def api_get_next_question(quiz_id: int, answer: AnswerAPI):
     - **currentCompetency**: Describes the proficiency of the examinee.
     - **quizFinished**: True if the quiz is already finished.
     """
-    if not ce.quiz_id_exists(quiz_id):
+    state = await load_quiz_state_async(quiz_id)
+    if state is None:
         raise HTTPException(
             status_code=404, detail="QuizAPI with id " + str(quiz_id) + " not found!")
-    if strtobool(r.get(ce.get_r_prefix(quiz_id) + "quizFinished").decode()):
+    if state["quizFinished"]:
         raise HTTPException(
             status_code=406, detail="No more questions for quiz with id " + str(quiz_id) + "!")
-    return ce.get_next_question(quiz_id, answer.isCorrect)
+    return await ce.get_next_question_async(state, answer.isCorrect)
 
 
 @CATModule.get("/quiz/{quiz_id}/result",
@@ -142,22 +247,14 @@ async def api_get_result(quiz_id: int):
     - **responses**: An ordered list of the responses to the administered questions.
     - **maxNumberOfQuestions**: The maximum number of questions the quiz could have had.
     """
-    if not ce.quiz_id_exists(quiz_id):
+    state = await load_quiz_state_async(quiz_id)
+    if state is None:
         raise HTTPException(status_code=404, detail="QuizAPI with id " +
                                                     str(quiz_id) + " not found!")
-    if r.get(
-            ce.get_r_prefix(
-                quiz_id) +
-            "questionSelector").decode("utf-8") == 'linearSelector' and (
-            not (
-                    strtobool(
-                        r.get(
-                            ce.get_r_prefix(
-                                quiz_id) +
-                            "quizFinished").decode()))):
+    if state["questionSelector"] == 'linearSelector' and not state["quizFinished"]:
         raise HTTPException(status_code=406, detail="QuizAPI with id " +
                                                     str(quiz_id) + " has not been finished yet!")
-    return ce.get_result(quiz_id)
+    return await ce.get_result_async(state)
 
 
 @CATModule.delete("/quiz", summary="Delete quiz with ID", tags=["quiz"])
@@ -170,10 +267,10 @@ async def api_delete_quiz(quiz_id_api: QuizIdAPI):
     Response:
     Status 200 OK if the quiz was successfully deleted.
     """
-    if not ce.quiz_id_exists(quiz_id_api.quizId):
+    if not await ce.quiz_id_exists_async(quiz_id_api.quizId):
         raise HTTPException(status_code=404, detail="QuizAPI with id " +
                                                     str(quiz_id_api.quizId) + " not found!")
-    ce.delete_quiz(quiz_id_api)
+    await ce.delete_quiz_async(quiz_id_api)
     return ("QuizAPI with id " +
             str(quiz_id_api.quizId) +
             " was successfully deleted!")
@@ -54,6 +54,12 @@ class ResultAPI(BaseModel):
     responses: List[float] = []  # contains the given answers for the administeredQuestions
 
 
+# Profiling settings for API --> Used to enable sampled profiling of the engine calls
+class ProfilingAPI(BaseModel):
+    sampleRate: float = 0.0  # share of the calls that are profiled, 0.0 disables profiling
+    mode: Optional[str] = "sampling"  # 'sampling' (collapsed stacks) or 'cprofile' (deterministic)
+
+
 # QuizID object for API
 class QuizIdAPI(BaseModel):
     quizId: int
@@ -67,4 +67,22 @@ class QuizLog(Base):
 class LastLogDate(Base):
     __tablename__ = "LastLogDate"  # singular, as there will be always one single date
 
-    date = Column(DATETIME(fsp=3), primary_key=True, autoincrement=False)
\ No newline at end of file
+    date = Column(DATETIME(fsp=3), primary_key=True, autoincrement=False)
+
+
+# quizzes whose calibration job has been applied, written in the same transaction as the new difficulties so a
+# retried job is never applied twice
+class CalibratedQuiz(Base):
+    __tablename__ = "CalibratedQuizzes"
+
+    quiz_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    calibration_time = Column(DateTime, nullable=False)
+
+
+# position up to which a logfile has been inserted into the db, updated in the same transaction as the inserted logs
+class LogCheckpoint(Base):
+    __tablename__ = "LogCheckpoints"
+
+    log_file = Column(String(255), primary_key=True)
+    inode = Column(BigInteger, nullable=False)  # a different inode means the logfile was rotated
+    offset = Column(BigInteger, nullable=False)  # bytes of the logfile already inserted